@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import socket
+import tempfile
+import argparse
+import platform
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.utils import Zopen, mkdir, log  # noqa: E402
+from src.src import HPCBlast, HPCBlastArg  # noqa: E402
+
+STUB_BLAST = r'''#!/usr/bin/env python
+import sys, zlib
+a = sys.argv[1:]
+def opt(k, d=None): return a[a.index(k)+1] if k in a else d
+q, o, db = opt("-query"), opt("-out"), opt("-db")
+mts = min(int(opt("-max_target_seqs", 5)), 5)
+with open(q) as fi, open(o, "w") as fo:
+    for line in fi:
+        if line.startswith(">"):
+            n = line[1:].split()[0]
+            hits = sorted(((zlib.crc32(("%s %s %d" % (n, d, k)).encode()) % 10000) / 1e6, "%s_%d" % (d.rsplit("/", 1)[-1], k))
+                          for d in db.split() for k in range(mts))
+            for ev, s in hits[:mts]:
+                fo.write("%s\t%s\t99.0\t100\t1\t0\t1\t100\t1\t100\t%g\t%.1f\n" % (n, s, ev, 200 - ev * 1e4))
+'''
+
+SPLITS = ["seqnum", "filesize", "part", "residues"]
+
+
+def read_lengths(n, dist, rnd):
+    if dist == "uniform":
+        return [rnd.randint(100, 200) for _ in range(n)]
+    return [min(int(rnd.lognormvariate(6, 1.2)) + 50, 100000) for _ in range(n)]
+
+
+def write_fastx(path, n, dist="uniform", fq=False, gz=False, seed=1):
+    rnd = random.Random(seed)
+    pool = bytes(rnd.choice(b"ACGT") for _ in range(1 << 18)) * 2
+    opener = gzip.open if gz else open
+    kw = gz and {"compresslevel": 1} or {}
+    with opener(path, "wb", **kw) as fo:
+        for i, length in enumerate(read_lengths(n, dist, rnd)):
+            s = rnd.randrange(len(pool) - length)
+            seq = pool[s:s + length]
+            if fq:
+                fo.write(b"@r%d\n%s\n+\n%s\n" % (i, seq, b"I" * len(seq)))
+            else:
+                fo.write(b">r%d len=%d\n" % (i, length))
+                fo.writelines(seq[p:p+80] + b"\n" for p in range(0, len(seq), 80))
+    return path
+
+
+def make_inputs(workdir, records):
+    inputs = []
+    for dist, n in [("uniform", records), ("skewed", records // 10)]:
+        for fq in [False, True]:
+            for gz in [False, True]:
+                name = "%s.%s%s" % (dist, fq and "fq" or "fa", gz and ".gz" or "")
+                path = os.path.join(workdir, "inputs", name)
+                if not os.path.isfile(path):
+                    write_fastx(path + ".tmp", n, dist, fq, gz)
+                    os.replace(path + ".tmp", path)
+                inputs.append(path)
+    return inputs
+
+
+def make_stub(workdir):
+    path = os.path.join(workdir, "bin", "blastn")
+    mkdir(os.path.dirname(path))
+    with open(path, "w") as fo:
+        fo.write(STUB_BLAST.replace("#!/usr/bin/env python",
+                 "#!" + sys.executable, 1))
+    os.chmod(path, 0o755)
+    os.environ["PATH"] = os.path.dirname(path) + os.pathsep + os.environ["PATH"]
+    return path
+
+
+def hpcblast(workdir, query, *opts):
+    tempdir = os.path.join(workdir, "tmp")
+    shutil.rmtree(tempdir, ignore_errors=True)
+    args, blast_options = HPCBlastArg(["--local", "--tempdir", tempdir] + list(opts) +
+                                      ["blastn", "-query", query, "-db", os.path.join(workdir, "db"),
+                                       "-outfmt", "6", "-out", os.path.join(workdir, "out.m6")])
+    return HPCBlast(args, blast_options)
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        setup = fn()
+        t = time.perf_counter()
+        setup()
+        times.append(time.perf_counter() - t)
+    return {"best": round(min(times), 4), "median": round(statistics.median(times), 4)}
+
+
+def bench_split(workdir, query, method, repeat):
+    def setup():
+        h = hpcblast(workdir, query)
+        h.finished = True
+        return {"seqnum": lambda: h.split_fastx_by_seqnum(10000),
+                "filesize": lambda: h.split_fastx_by_filesize(4 << 20),
+                "part": lambda: h.split_fastx_by_part(10),
+                "residues": lambda: h.split_fastx_by_residues(10)}[method]
+    return timed(setup, repeat)
+
+
+def bench_zopen(query, repeat):
+    def read():
+        with Zopen(query) as fi:
+            while fi.read(1 << 22):
+                pass
+    return timed(lambda: read, repeat)
+
+
+def bench_merge(workdir, query, chunks, rows, repeat):
+    resdir = os.path.join(workdir, "merge")
+    mkdir(resdir)
+    results = []
+    for i in range(chunks):
+        results.append(os.path.join(resdir, "result.%05d" % i))
+        with open(results[-1], "w") as fo:
+            fo.writelines("r%d\ts_%d\t99.0\t100\t1\t0\t1\t100\t1\t100\t%g\t180.0\n" % (n, n % 7, n / 1e6)
+                          for n in range(i * rows, (i + 1) * rows))
+
+    def setup():
+        h = hpcblast(workdir, query)
+        h.chunk_res.extend(results)
+        return h.mergs_res
+    return timed(setup, repeat)
+
+
+def bench_e2e(workdir, query, split, repeat):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep +
+               os.environ.get("PYTHONPATH", ""))
+    out = os.path.join(workdir, "e2e.m6")
+
+    def run():
+        with open(os.path.join(workdir, "bench.log"), "a") as fo:
+            subprocess.check_call([sys.executable, "-m", "src.main", "--local", "--split", str(split), "blastn",
+                                   "-query", query, "-db", os.path.join(workdir, "db"), "-outfmt", "6", "-out", out],
+                                  cwd=workdir, env=env, stdout=fo, stderr=subprocess.STDOUT)
+    return timed(lambda: run, repeat)
+
+
+def git_commit():
+    try:
+        rev = subprocess.check_output(
+            ["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(
+            ["git", "-C", ROOT, "status", "--porcelain", "--untracked-files=no"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return rev + (dirty and "-dirty" or "")
+
+
+def run_benchmarks(args):
+    workdir = os.path.abspath(args.workdir)
+    mkdir(os.path.join(workdir, "inputs"))
+    make_stub(workdir)
+    logger = log(os.path.join(workdir, "bench.log"))
+    logger.handlers = logger.handlers[-1:]
+    inputs = make_inputs(workdir, int(200000 * args.scale))
+    cases = []
+
+    def add(name, query, result):
+        size = query and os.path.getsize(query) or 0
+        cases.append(dict(name=name, bytes=size, mb_per_s=size and round(
+            size / 2**20 / max(result["best"], 1e-9), 2), **result))
+        print("%-40s best %8.3fs  median %8.3fs  %s" % (name, result["best"], result["median"],
+                                                       size and "%.1f MB/s" % cases[-1]["mb_per_s"] or ""))
+    for query in inputs:
+        name = os.path.basename(query)
+        if "zopen" in args.cases:
+            add("zopen/" + name, query, bench_zopen(query, args.repeat))
+        if "split" in args.cases:
+            for method in SPLITS:
+                add("split_%s/%s" % (method, name), query,
+                    bench_split(workdir, query, method, args.repeat))
+    if "merge" in args.cases:
+        add("mergs_res/64x%d" % int(20000 * args.scale), None,
+            bench_merge(workdir, inputs[0], 64, int(20000 * args.scale), args.repeat))
+    if "e2e" in args.cases:
+        for query in [inputs[0], inputs[-1]]:
+            add("e2e_local/" + os.path.basename(query), query,
+                bench_e2e(workdir, query, 8, args.repeat))
+    return {"commit": git_commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "host": socket.gethostname(),
+            "python": platform.python_version(), "scale": args.scale, "repeat": args.repeat, "cases": cases}
+
+
+def compare(base, new, threshold=0.1):
+    with open(base) as fi:
+        b = {c["name"]: c for c in json.load(fi)["cases"]}
+    with open(new) as fi:
+        n = {c["name"]: c for c in json.load(fi)["cases"]}
+    slower = 0
+    for name in [k for k in n if k in b]:
+        ratio = n[name]["best"] / max(b[name]["best"], 1e-9)
+        flag = ratio > 1 + threshold and "slower" or ratio < 1 - \
+            threshold and "faster" or ""
+        slower += flag == "slower"
+        print("%-40s %8.3fs -> %8.3fs  x%.2f  %s" %
+              (name, b[name]["best"], n[name]["best"], ratio, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark query splitting, reading, result merging and end-to-end --local runs on synthetic inputs with a stub blastn")
+    parser.add_argument("--workdir", type=str,
+                        help="directory of synthetic inputs and temp files, kept for reuse, a temporary directory removed afterwards by default", metavar="<dir>")
+    parser.add_argument("--outdir", type=str, default=os.path.join(ROOT, "benchmarks", "results"),
+                        help="directory of result json files named by git commit, benchmarks/results by default", metavar="<dir>")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale input sizes, 1.0 by default (200000 uniform records)", metavar="<float>")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per case, best and median reported, 3 by default", metavar="<int>")
+    parser.add_argument("--cases", type=str, nargs="+", default=["zopen", "split", "merge", "e2e"],
+                        choices=["zopen", "split", "merge", "e2e"], help="cases to run, all by default", metavar="<str>")
+    parser.add_argument("--compare", type=str, nargs=2,
+                        help="compare two result json files and exit non-zero if any case is more than --threshold slower", metavar=("<base>", "<new>"))
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported by --compare, 0.1 by default", metavar="<float>")
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(compare(*args.compare, threshold=args.threshold) and 1 or 0)
+    tmpdir = not args.workdir and tempfile.mkdtemp(prefix="hpc_blast_bench_")
+    args.workdir = args.workdir or tmpdir
+    try:
+        report = run_benchmarks(args)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    mkdir(args.outdir)
+    out = os.path.join(args.outdir, "%s.json" % report["commit"])
+    with open(out, "w") as fo:
+        json.dump(report, fo, indent=1)
+    print("results written to %s" % out)
+
+
+if __name__ == "__main__":
+    main()
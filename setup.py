@@ -78,6 +78,7 @@ class Packages(object):
             url="https://github.com/yodeng/hpc-blast",
             package_dir={self.name: os.path.basename(self.source_dir)},
             install_requires=self.requirements,
+            extras_require={"numpy": ["numpy"], "zstd": ["zstandard"]},
             python_requires='>=3.8',
             long_description=self.description,
             long_description_content_type='text/markdown',
@@ -92,6 +93,12 @@ class Packages(object):
     def _entrys(self):
         eps = [
             '%s = %s.main:main' % ("hpc-blast", self.name),
+            '%s = %s.warmup:main' % ("hpc-blast-warmup", self.name),
+            '%s = %s.worker:main' % ("hpc-blast-worker", self.name),
+            '%s = %s.scratch:main' % ("hpc-blast-scratch", self.name),
+            '%s = %s.measure:main' % ("hpc-blast-measure", self.name),
+            '%s = %s.compress:main' % ("hpc-blast-compress", self.name),
+            '%s = %s.formatter:main' % ("hpc-blast-formatter", self.name),
         ]
         return eps
 
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+from .utils import *
+
+
+def run_blast(cmd, threads=1, level=6):
+    cmd = list(cmd)
+    o = cmd.index("-out")
+    out = cmd[o + 1]
+    del cmd[o:o + 2]
+    tmp = "%s.%d.tmp" % (out, os.getpid())
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        with BgzfWriter(tmp, threads, level, eof=False) as fo:
+            for block in iter(lambda: proc.stdout.read(1 << 20), b""):
+                fo.write(block)
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc:
+        os.remove(tmp)
+        return rc
+    os.replace(tmp, out)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run one blast chunk job with its output piped through a bgzf compressor into -out")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="compression threads, 1 by default", metavar="<int>")
+    parser.add_argument("--level", type=int, default=6,
+                        help="compression level, 6 by default", metavar="<int>")
+    parser.add_argument("blast", nargs=argparse.REMAINDER,
+                        help="blast command with -out", metavar="<blast command>")
+    args = parser.parse_args()
+    cmd = args.blast[1:] if args.blast[:1] == ["--"] else args.blast
+    sys.exit(run_blast(cmd, args.threads, args.level))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from .utils import *
+
+
+def format_archive(formatter, archive, outfmt, out):
+    tmp = "%s.%d.tmp" % (out, os.getpid())
+    rc = subprocess.call([formatter, "-archive", archive,
+                         "-outfmt", outfmt, "-out", tmp])
+    if rc:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return rc
+    os.replace(tmp, out)
+    return 0
+
+
+def run_blast(cmd, formatter, formats):
+    cmd = list(cmd)
+    o = cmd.index("-out") + 1
+    if "-outfmt" not in cmd:
+        cmd.extend(["-outfmt", "0"])
+    f = cmd.index("-outfmt") + 1
+    out, outfmt = cmd[o], cmd[f]
+    formats = [(fmt, path) for fmt, path in formats]
+    archive = out
+    if outfmt.split()[0] != "11":
+        archive = cmd[o] = out + ".asn"
+        cmd[f] = "11"
+        formats.insert(0, (outfmt, out))
+    rc = subprocess.call(cmd)
+    if rc:
+        return rc
+    with ThreadPoolExecutor(len(formats)) as ex:
+        rcs = list(ex.map(lambda x: format_archive(
+            formatter, archive, *x), formats))
+    if archive != out and not any(rcs):
+        os.remove(archive)
+    return max(rcs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run one blast chunk job as an -outfmt 11 archive and format it into every requested format in parallel")
+    parser.add_argument("--formatter", type=str, default="blast_formatter",
+                        help="blast_formatter path", metavar="<file>")
+    parser.add_argument("--extra", type=str, nargs=2, action="append", default=[],
+                        help="extra output format and file, can be used multiple times", metavar=("<outfmt>", "<file>"))
+    parser.add_argument("blast", nargs=argparse.REMAINDER,
+                        help="blast command with -out and -outfmt", metavar="<blast command>")
+    args = parser.parse_args()
+    cmd = args.blast[1:] if args.blast[:1] == ["--"] else args.blast
+    sys.exit(run_blast(cmd, args.formatter, args.extra))
+
+
+if __name__ == "__main__":
+    main()
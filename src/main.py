@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
-from .src import HPCBlast, HPCBlastArg
+import sys
+
+from .src import HPCBlast, HPCBlastBatch, HPCBlastArg
 
 
 def main():
-    HPCBlast(*HPCBlastArg()).run()
+    args, blast_options = HPCBlastArg()
+    if getattr(args, "outfile", None) is None and not args.batch:
+        sys.exit("hpc-blast: error: -out is required")
+    if args.batch:
+        HPCBlastBatch(args, blast_options).run()
+    else:
+        HPCBlast(args, blast_options).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import socket
+
+from .utils import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run a command and append its host, start and end time, exit status and peak resident memory in bytes as one json line")
+    parser.add_argument("--stats", type=str, required=True,
+                        help="output file of command stats, one line per attempt", metavar="<file>")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER,
+                        help="command to run", metavar="<command>")
+    args = parser.parse_args()
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    start = time.time()
+    rc = subprocess.call(cmd)
+    stats = {"host": socket.gethostname(), "start": round(start, 3), "end": round(time.time(), 3), "exit": rc,
+             "rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss << 10}
+    with open(args.stats, "a") as fo:
+        fo.write(json.dumps(stats) + "\n")
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    main()
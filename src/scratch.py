@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import json
+import fcntl
+import socket
+
+from .utils import *
+
+
+def stage_db(filelist, db, scratch):
+    with open(filelist) as fi:
+        files = [f.strip() for f in fi if f.strip()]
+    names = {os.path.basename(f) for f in files}
+    if not files or len(names) < len(files):
+        return db
+    stats = [(f, os.stat(f)) for f in files]
+    key = hashlib.blake2b(json.dumps([(f, st.st_size, st.st_mtime_ns) for f, st in stats]).encode(),
+                          digest_size=8).hexdigest()
+    root = os.path.join(scratch, "hpc-blast-db")
+    os.makedirs(root, exist_ok=True)
+    dest = os.path.join(root, key)
+    with open(dest + ".lock", "w") as lk:
+        fcntl.flock(lk, fcntl.LOCK_EX)
+        if not os.path.isdir(dest):
+            if shutil.disk_usage(root).free < sum(st.st_size for _, st in stats) * 1.1:
+                return db
+            tmp = dest + ".tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            mkdir(tmp)
+            for f in files:
+                shutil.copyfile(f, os.path.join(tmp, os.path.basename(f)))
+            os.rename(tmp, dest)
+    return " ".join(os.path.join(dest, os.path.basename(d)) for d in db.split())
+
+
+def run_blast(cmd, scratch, filelist=None):
+    cmd = list(cmd)
+    q, o = cmd.index("-query") + 1, cmd.index("-out") + 1
+    query, out = cmd[q], cmd[o]
+    os.makedirs(scratch, exist_ok=True)
+    local = tempfile.mkdtemp(prefix="hpc-blast_", dir=scratch)
+    try:
+        cmd[q] = os.path.join(local, os.path.basename(query))
+        cmd[o] = os.path.join(local, os.path.basename(out))
+        shutil.copyfile(query, cmd[q])
+        if filelist:
+            d = cmd.index("-db") + 1
+            cmd[d] = stage_db(filelist, cmd[d], scratch)
+        rc = subprocess.call(cmd)
+        if not rc:
+            tmp = "%s.%s.%d" % (out, socket.gethostname(), os.getpid())
+            shutil.move(cmd[o], tmp)
+            os.replace(tmp, out)
+        return rc
+    finally:
+        shutil.rmtree(local, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run one blast chunk job in node-local scratch and move its result back")
+    parser.add_argument("--scratch", type=str, required=True,
+                        help="node-local directory, environment variables expanded", metavar="<dir>")
+    parser.add_argument("--db-files", type=str,
+                        help="file with one database file per line, stage them to --scratch once per node", metavar="<file>")
+    parser.add_argument("blast", nargs=argparse.REMAINDER,
+                        help="blast command with -query, -out and -db", metavar="<blast command>")
+    args = parser.parse_args()
+    cmd = args.blast[1:] if args.blast[:1] == ["--"] else args.blast
+    sys.exit(run_blast(cmd, os.path.expandvars(args.scratch), args.db_files))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,21 @@
 
 from .utils import *
 
-__all__ = ["HPCBlast", "HPCBlastArg"]
+__all__ = ["HPCBlast", "HPCBlastBatch", "HPCBlastArg"]
 
 
 class HPCBlast(object):
 
     def __init__(self, args=None, blast_options=None):
-        self.outfile = os.path.abspath(args.outfile)
+        if getattr(args, "outfile", None) is None:
+            self.outfile, outdir = os.devnull, os.getcwd()
+        elif args.outfile == "-":
+            self.outfile, outdir = detach_stdout(), os.getcwd()
+        else:
+            self.outfile = os.path.abspath(args.outfile)
+            outdir = os.path.dirname(self.outfile)
         self.tempdir = os.path.abspath(args.tempdir or tempfile.mktemp(
-            prefix="hpc-blast_", dir=os.path.dirname(self.outfile)))
+            prefix="hpc-blast_", dir=outdir))
         self.args = args
         self._create_args()
         self.btype = args.blast
@@ -20,12 +26,92 @@ class HPCBlast(object):
         self.blast_options = blast_options
         self.chunk_files = []
         self.chunk_res = []
+        self.chunk_residues = []
         self.blast_scripts = ""
+        self.on_chunk = None
+        self.db_shards = {}
+        self.shard_res = {}
+        self.shard_parent = {}
+        self.shard_done = set()
+        self.merge_dbsize = 0
+        self.db_parts = {}
+        self.db_group = {}
+        self.db_done = set()
+        self.db_merged = set()
+        self.dedup_index = {}
+        self.dedup_dups = {}
+        self.dedup_total = 0
+        self.deferred = []
+        self.split_done = False
+        self.lock = Lock()
+        self.cache = None
+        self.cache_ns = []
+        self.cache_file = None
+        self.cache_hits = self.cache_total = 0
+        self.result_chunk = {}
+        self.completed = set()
+        self.resources = None
+        self.metrics = RunMetrics()
+        self.manifest = Manifest(os.path.join(self.tempdir, "manifest.jsonl"))
+        self.warmup_dir = os.path.join(self.tempdir, "warmup")
+        self.merger = ResultMerger(self.outfile, self.chunk_res, self.outfmt)
+        self.extra_formats = [(fmt, os.path.abspath(f))
+                              for fmt, f in args.extra_outfmt or []]
+        self.extra_mergers = [ResultMerger(f, [], fmt.split()[0])
+                              for fmt, f in self.extra_formats]
         self.finished = False
         self.loger = log(args.log, "info")
         if not self.blast_exe or not "blast" in os.path.basename(self.blast_exe):
             raise ArgumentsError(
                 "blast not found in this environment")
+        self._quotation_outfmt()
+        if self.extra_formats:
+            self.formatter = which("blast_formatter") or which(
+                os.path.join(os.path.dirname(self.blast_exe), "blast_formatter"))
+            if not self.formatter:
+                raise ArgumentsError(
+                    "blast_formatter not found in this environment")
+            if args.dedup or args.cache or args.db_shards is not None or args.merge_dbs:
+                raise ArgumentsError(
+                    "--extra-outfmt can not be used with --dedup, --cache, --db-shards or --merge-dbs")
+            if any(fmt.split()[0] == "11" for fmt, _ in self.extra_formats):
+                raise ArgumentsError(
+                    "--extra-outfmt 11 archives can not be merged")
+        tabular = self.outfmt in ["6", "10"] and "qseqid" in self.outfmt_columns
+        if args.db_shards is not None and not (tabular and {"sseqid", "evalue"} <= set(self.outfmt_columns)):
+            raise ArgumentsError(
+                "--db-shards requires tabular -outfmt 6/10 with qseqid, sseqid and evalue columns")
+        if args.merge_dbs and not (tabular and {"sseqid", "evalue"} <= set(self.outfmt_columns)):
+            raise ArgumentsError(
+                "--merge-dbs requires tabular -outfmt 6/10 with qseqid, sseqid and evalue columns")
+        if args.merge_dbs and args.cache:
+            raise ArgumentsError("--merge-dbs can not be used with --cache")
+        if args.dedup and not tabular:
+            raise ArgumentsError(
+                "--dedup requires tabular -outfmt 6/10 with qseqid column")
+        if args.cache and not tabular:
+            raise ArgumentsError(
+                "--cache requires tabular -outfmt 6/10 with qseqid column")
+        if args.compress_results and (self.outfmt not in ["6", "7", "10"] or args.dedup or args.cache or
+                                      args.db_shards is not None or args.merge_dbs or args.extra_outfmt):
+            raise ArgumentsError(
+                "--compress-results requires tabular -outfmt 6/7/10 and can not be used with --dedup, --cache, "
+                "--db-shards, --merge-dbs or --extra-outfmt")
+        if args.auto_resources and args.dynamic:
+            raise ArgumentsError(
+                "--auto-resources can not be used with --dynamic")
+        if args.auto_resources:
+            self.resources = ResourceModel(
+                os.path.basename(self.btype), floor=args.memory)
+        if args.scratch_db and not args.scratch:
+            raise ArgumentsError("--scratch-db requires --scratch")
+        if args.pool and not args.local:
+            raise ArgumentsError("--pool only works with --local")
+        if args.auto and self.query == "-":
+            raise ArgumentsError("--auto can not sample query from stdin")
+        if args.array and (args.local or args.pool or args.pipeline):
+            raise ArgumentsError(
+                "--array only works with sge/slurm and without --pipeline")
         self.cleandir = not args.tempdir
 
     def _quotation_outfmt(self):
@@ -44,6 +130,30 @@ class HPCBlast(object):
                     e = s + n
                 self.blast_options[s:e+1] = [" ".join(op)]
 
+    @property
+    def outfmt(self):
+        if "-outfmt" in self.blast_options:
+            fmt = self.blast_options[self.blast_options.index("-outfmt")+1]
+            return fmt.strip("'").strip('"').split()[0]
+        return "0"
+
+    @property
+    def outfmt_columns(self):
+        return outfmt_columns(self._blast_option("-outfmt", "6").strip("'").strip('"'))
+
+    @property
+    def outfmt_sep(self):
+        return self.outfmt == "10" and b"," or b"\t"
+
+    @property
+    def fold_case(self):
+        return "-lcase_masking" not in self.blast_options
+
+    def _blast_option(self, name, default=None):
+        if name in self.blast_options:
+            return self.blast_options[self.blast_options.index(name)+1]
+        return default
+
     def _create_args(self):
         self.args.mode = "sge"
         if self.args.local:
@@ -54,216 +164,972 @@ class HPCBlast(object):
         self.args.workdir = os.getcwd()
         self.args.startline = 0
         self.args.groups = 1
+        if self.args.query == "-":
+            if not (self.args.split or self.args.size or self.args.filesize or self.args.auto):
+                self.args.filesize = "64M"
+            self.args.pipeline = not (self.args.dynamic or self.args.array)
+        if self.args.split is None:
+            self.args.split = self.args.dynamic and self.args.dynamic * 8 or 10
+
+    def _chunk_file(self, i):
+        return os.path.join(self.tempdir, "chunks", chunk_bucket(i), "split.%05d.fa" % i)
+
+    def _chunk_files(self, part):
+        self.chunk_files = [self._chunk_file(i) for i in range(part)]
+        for d in sorted({os.path.dirname(fa) for fa in self.chunk_files}):
+            os.makedirs(d, exist_ok=True)
+        return self.chunk_files
+
+    def _new_chunk(self):
+        fo = self._chunk_file(len(self.chunk_files))
+        os.makedirs(os.path.dirname(fo), exist_ok=True)
+        self.chunk_files.append(fo)
+        return open(fo, "wb", buffering=1 << 22)
+
+    def _close_chunk(self, fh):
+        fh.close()
+        self._chunk_ready(fh.name)
+
+    def _chunk_ready(self, fa):
+        self.manifest.add("chunk", fa)
+        if self.on_chunk and os.path.getsize(fa):
+            self.on_chunk(fa)
+
+    def _query_blocks(self, fi):
+        for buf, offsets in fi:
+            if self.cache:
+                buf, offsets = self._cached_records(buf, offsets)
+            if self.args.dedup:
+                self.dedup_total += len(offsets) - 1
+                buf, offsets = dedup_records(
+                    buf, offsets, self.dedup_index, self.dedup_dups, self.fold_case)
+            if len(offsets) > 1:
+                yield buf, offsets
+
+    def _init_cache(self):
+        if not self.args.cache or self.cache:
+            return
+        dbtype = blast_dbtype[os.path.basename(self.btype)]
+        opts = blast_options_key(self.blast_options)
+        self.cache_ns = [hashlib.blake2b(json.dumps([os.path.basename(self.btype), opts, blastdb_fingerprint(
+            os.path.abspath(db), dbtype)]).encode(), digest_size=16).digest() for db in self.db]
+        self.cache = ResultCache(
+            self.args.cache, human_size_parse(self.args.cache_size))
+
+    def _cache_keys(self, digest):
+        return [hashlib.blake2b(ns + digest, digest_size=16).digest() for ns in self.cache_ns]
+
+    def _cached_records(self, buf, offsets):
+        recs = [(qid, self._cache_keys(d))
+                for qid, d in fasta_digests(buf, offsets, self.fold_case)]
+        found = self.cache.get(chain.from_iterable(k for _, k in recs))
+        keep, qcol = [], self.outfmt_columns.index("qseqid")
+        for i, (qid, keys) in enumerate(recs):
+            if all(k in found for k in keys):
+                for k in keys:
+                    self.cache_file.writelines(replace_column(
+                        found[k].splitlines(True), qcol, qid, self.outfmt_sep))
+            else:
+                keep.append(i)
+        self.cache_total += len(recs)
+        self.cache_hits += len(recs) - len(keep)
+        return fasta_subset(buf, offsets, keep)
+
+    def _cache_result(self, raw):
+        fa, n = self.result_chunk[raw]
+        with open(raw, "rb") as fi:
+            groups = {qid: b"".join(lines) for qid, lines in tabular_groups(
+                fi, self.outfmt_columns.index("qseqid"), self.outfmt_sep)}
+        items = []
+        with FastxReader(fa, "fasta") as fi:
+            for buf, offsets in fi:
+                for qid, d in fasta_digests(buf, offsets, self.fold_case):
+                    hits = groups.get(qid) or groups.get(
+                        qid.split(b"lcl|", 1)[-1], b"")
+                    items.append((self._cache_keys(d)[n], hits))
+        self.cache.put(items)
+
+    def _close_cache(self):
+        if not self.cache_file:
+            return
+        self.cache_file.close()
+        self.loger.info("result cache: %d hits, %d misses of %d query records (%.1f%% hit ratio)",
+                        self.cache_hits, self.cache_total - self.cache_hits, self.cache_total,
+                        self.cache_total and 100.0 * self.cache_hits / self.cache_total or 0.0)
+        if os.path.getsize(self.cache_file.name):
+            self.manifest.add("result", self.cache_file.name)
+            self.chunk_res.append(self.cache_file.name)
+            self.merger.finish(self.cache_file.name)
 
     def split_fastx_by_seqnum(self, seq_num=0):
         if seq_num <= 0:
             return
-        if os.path.isfile(self.query):
-            mkdir(os.path.join(self.tempdir, "chunks"))
-        fx = get_fastx_type(self.query)
+        mkdir(os.path.join(self.tempdir, "chunks"))
         s = fh = 0
-        with Zopen(self.query, mode="rb") as fi:
-            if fx == "fasta":
-                for line in fi:
-                    if line.startswith(b">"):
-                        n, mod = divmod(s, seq_num)
-                        s += 1
-                        if mod == 0:
-                            if fh:
-                                fh.close()
-                            fo = os.path.join(
-                                self.tempdir, "chunks", "split.%05d.fa" % n)
-                            self.chunk_files.append(fo)
-                            fh = open(fo, "wb")
-                    fh.write(line)
-            elif fx == "fastq":
-                for i, line in enumerate(fi):
-                    x = i % 4
-                    if x == 0:
-                        n, mod = divmod(s, seq_num)
-                        s += 1
-                        if mod == 0:
-                            if fh:
-                                fh.close()
-                            fo = os.path.join(
-                                self.tempdir, "chunks", "split.%05d.fa" % n)
-                            self.chunk_files.append(fo)
-                            fh = open(fo, "wb")
-                        line = b">" + line[1:]
-                    elif x > 1:
-                        continue
-                    fh.write(line)
+        with FastxReader(self.query) as fi:
+            for buf, offsets in self._query_blocks(fi):
+                p = 0
+                for i in range(-s % seq_num, len(offsets) - 1, seq_num):
+                    if fh:
+                        fh.write(buf[p:offsets[i]])
+                        self._close_chunk(fh)
+                    fh = self._new_chunk()
+                    p = offsets[i]
+                fh.write(buf[p:])
+                s += len(offsets) - 1
         if fh:
-            fh.close()
+            self._close_chunk(fh)
 
     def split_fastx_by_filesize(self, file_size=0):
         if file_size <= 0:
             return
-        if os.path.isfile(self.query):
-            mkdir(os.path.join(self.tempdir, "chunks"))
-        fx = get_fastx_type(self.query)
-        s = n = fh = 0
-        with Zopen(self.query, mode="rb") as fi:
-            seq = name = b""
-            if fx == "fasta":
-                for line in fi:
-                    if line.startswith(b">"):
-                        if not seq:
-                            fo = os.path.join(
-                                self.tempdir, "chunks", "split.%05d.fa" % n)
-                            self.chunk_files.append(fo)
-                            fh = open(fo, "wb")
-                            n += 1
-                        else:
-                            if s and s + len(seq) + len(name) > file_size:
-                                fh.close()
-                                fo = os.path.join(
-                                    self.tempdir, "chunks", "split.%05d.fa" % n)
-                                self.chunk_files.append(fo)
-                                fh = open(fo, "wb")
-                                n += 1
-                                s = 0
-                            s += fh.write(name+seq)
-                        seq = b""
-                        name = line
-                    else:
-                        seq += line
-            elif fx == "fastq":
-                for i, line in enumerate(fi):
-                    x = i % 4
-                    if x == 0:
-                        if not seq:
-                            fo = os.path.join(
-                                self.tempdir, "chunks", "split.%05d.fa" % n)
-                            self.chunk_files.append(fo)
-                            fh = open(fo, "wb")
-                            n += 1
-                        else:
-                            if s and s + len(seq) + len(name) > file_size:
-                                fh.close()
-                                fo = os.path.join(
-                                    self.tempdir, "chunks", "split.%05d.fa" % n)
-                                self.chunk_files.append(fo)
-                                fh = open(fo, "wb")
-                                n += 1
-                                s = 0
-                            s += fh.write(name+seq)
-                        seq = b""
-                        name = line
-                    elif x == 1:
-                        seq += line
-            if name and seq:
-                if s and s + len(seq) + len(name) > file_size:
-                    fh.close()
-                    fo = os.path.join(
-                        self.tempdir, "chunks", "split.%05d.fa" % n)
-                    self.chunk_files.append(fo)
-                    fh = open(fo, "wb")
-                    n += 1
-                    s = 0
-                s += fh.write(name+seq)
+        mkdir(os.path.join(self.tempdir, "chunks"))
+        s = fh = 0
+        with FastxReader(self.query) as fi:
+            for buf, offsets in self._query_blocks(fi):
+                p = 0
+                while p < len(buf):
+                    if not fh:
+                        fh, s = self._new_chunk(), 0
+                    limit = p + file_size - s
+                    if limit >= len(buf):
+                        s += fh.write(buf[p:])
+                        break
+                    e = offsets[bisect.bisect_right(offsets, limit) - 1]
+                    if e <= p and not s:
+                        e = offsets[bisect.bisect_right(offsets, p)]
+                    fh.write(buf[p:e])
+                    self._close_chunk(fh)
+                    fh, p = 0, e
         if fh:
-            fh.close()
+            self._close_chunk(fh)
+
+    def _progressive_part_size(self, part):
+        if not self.on_chunk:
+            return 0
+        if self.query == "-":
+            self.loger.warning(
+                "--split %d of stdin is only cut after the whole query is read, use --filesize to overlap splitting with blast jobs", part)
+            return 0
+        if get_fastx_type(self.query) == "fasta" and not self.query.endswith(".gz") and \
+                not (self.args.dedup or self.cache):
+            return 0
+        buf, offsets, records, _ = fastx_sample(self.query)
+        if len(offsets) < 2:
+            return 0
+        return int(len(buf) * records / (len(offsets) - 1) / part * 1.02) + 1
 
     def split_fastx_by_part(self, part=10):
-        self.chunk_files = [os.path.join(
-            self.tempdir, "chunks", "split.%05d.fa" % i) for i in range(part)]
-        if os.path.isfile(self.query):
-            mkdir(os.path.join(self.tempdir, "chunks"))
-        fx = get_fastx_type(self.query)
-        num = 0
-        with Zopen(self.query, mode="rb") as fi, MultiFileOpen(mode="wb", *self.chunk_files) as fo:
-            if fx == "fasta":
-                for line in fi:
-                    if line.startswith(b">"):
-                        fh = fo[num % part]
-                        num += 1
-                    fh.write(line)
-            elif fx == "fastq":
-                for i, line in enumerate(fi):
-                    x = i % 4
-                    if x == 0:
-                        fh = fo[num % part]
-                        num += 1
-                        line = b">" + line[1:]
-                    elif x > 1:
-                        continue
-                    fh.write(line)
+        size = self._progressive_part_size(part)
+        if size:
+            self.loger.info(
+                "cut query into ~%d chunks of %d bytes as they fill", part, size)
+            return self.split_fastx_by_filesize(size)
+        self._chunk_files(part)
+        with FastxReader(self.query) as fi:
+            if fi.size and not (self.args.dedup or self.cache):
+                cuts = [fi.next_record(fi.size * i // part)
+                        for i in range(part + 1)]
+                for i, fa in enumerate(self.chunk_files):
+                    with open(fa, "wb") as fo:
+                        copy_range(fi.handler, fo, cuts[i], cuts[i+1]-cuts[i])
+                    self._chunk_ready(fa)
+                return
+            with ChunkWriter(*self.chunk_files) as fo:
+                for n, (buf, offsets) in enumerate(self._query_blocks(fi)):
+                    p = 0
+                    for i in range(part):
+                        e = offsets[bisect.bisect_left(
+                            offsets, len(buf) * (i + 1) // part)]
+                        if e > p:
+                            fo.write((n + i) % part, buf[p:e])
+                            p = e
+        for fa in self.chunk_files:
+            self._chunk_ready(fa)
 
-    @property
-    def cache_blast_db(self):
-        blastdb_path = which("blastdb_path")
-        vmtouch = which("vmtouch")
+    def split_fastx_by_residues(self, part=10):
+        if self.on_chunk:
+            self.loger.warning(
+                "--balance residues packs chunks from the whole query, blast jobs start after splitting finished")
+        self._chunk_files(part)
+        loads = [(0, i) for i in range(part)]
+        with FastxReader(self.query) as fi, ChunkWriter(*self.chunk_files) as fo:
+            for buf, offsets in self._query_blocks(fi):
+                res = fasta_residues(buf, offsets)
+                bins = {}
+                for r in sorted(range(len(res)), key=res.__getitem__, reverse=True):
+                    load, i = loads[0]
+                    heapq.heapreplace(loads, (load + res[r], i))
+                    bins.setdefault(i, []).append(buf[offsets[r]:offsets[r+1]])
+                for i, recs in bins.items():
+                    fo.write(i, b"".join(recs))
+        for fa in self.chunk_files:
+            self._chunk_ready(fa)
+        self.chunk_residues = [0] * part
+        for load, i in loads:
+            self.chunk_residues[i] = load
+        mean = sum(self.chunk_residues) / part
+        self.loger.info("split query into %d chunks by residues, imbalance ratio (max/mean): %.3f",
+                        part, mean and max(self.chunk_residues) / mean or 1.0)
+
+    def _calibrate(self, fa, db):
+        opts = list(self.blast_options)
+        if "-num_threads" in opts:
+            del opts[opts.index("-num_threads"):opts.index("-num_threads")+2]
+        stats = fa + ".stats"
+        cmd = [sys.executable, "-m", __package__ + ".measure", "--stats", stats, "--", self.blast_exe] + opts + \
+            ["-num_threads", "1", "-query", fa, "-db", os.path.abspath(db), "-out", os.devnull]
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+        r = read_stats(stats)[-1]
+        os.remove(stats)
+        return r["end"] - r["start"], r["rss"]
+
+    def auto_plan(self):
+        if not self.args.auto:
+            return
+        target = human_time_parse(self.args.auto)
+        buf, offsets, records, residues = fastx_sample(self.query)
+        if len(offsets) < 2:
+            return
+        auto = os.path.join(self.tempdir, "auto")
+        mkdir(auto)
+        with open(os.path.join(auto, "first.fa"), "wb") as fo:
+            fo.write(buf[:offsets[1]])
+        with open(os.path.join(auto, "sample.fa"), "wb") as fo:
+            fo.write(buf)
+        sampled = sum(fasta_residues(buf, offsets))
+        startup = elapsed = base = per_residue = 0.0
+        for db in self.db:
+            t0, rss0 = self._calibrate(os.path.join(auto, "first.fa"), db)
+            t1, rss1 = self._calibrate(os.path.join(auto, "sample.fa"), db)
+            startup, elapsed = startup + t0, elapsed + t1
+            base = max(base, rss0)
+            per_residue = max(per_residue, max(rss1 - rss0, 0) / sampled)
+        shutil.rmtree(auto, ignore_errors=True)
+        rate = sampled / max(elapsed - startup, 1e-3)
+        memory = self.args.memory * 2**30
+        if "-num_threads" in self.blast_options:
+            candidates = [int(self._blast_option("-num_threads"))]
+        else:
+            candidates = range(1, max(self.args.cpu or 1, 1) + 1)
+        plans = []
+        for threads in candidates:
+            part = -(-residues // int(rate * threads *
+                     max(target - startup, 1.0) or 1))
+            room = memory - base - (threads - 1) * (64 << 20)
+            fits = room > 0
+            if fits:
+                part = max(part, -(-int(residues * per_residue) // int(room)))
+            part = max(min(part, records), 1)
+            if self.args.num and part > self.args.num:
+                part = -(-part // self.args.num) * self.args.num
+            waves = self.args.num and -(-part // self.args.num) or 1
+            wall = waves * (startup + residues / part / (rate * threads))
+            rss = base + residues / part * per_residue + \
+                (threads - 1) * (64 << 20)
+            late = wall > target
+            plans.append((not fits, late, late and wall or threads * part,
+                          threads, part, wall, rss))
+        _, _, _, threads, part, wall, rss = min(plans)
+        if "-num_threads" not in self.blast_options:
+            self.blast_options.extend(["-num_threads", str(threads)])
+            self.args.cpu = threads
+        self.args.split, self.args.size, self.args.filesize = part, None, None
+        self.args.balance = "residues"
+        self.loger.info("auto plan: ~%d records, ~%d residues, %.4g residues/s per thread, %.1fs startup, "
+                        "%.2fG base + %.0f bytes/residue peak rss -> %d chunks x %d threads, %s parallel, "
+                        "predicted wall time %.0fs (target %.0fs), predicted peak rss %.2fG (--memory %dG)",
+                        records, residues, rate, startup, base / 2**30, per_residue, part, threads,
+                        self.args.num or "all", wall, target, rss / 2**30, self.args.memory)
+        if rss > memory:
+            self.loger.warning("predicted peak rss %.2fG of chunk jobs exceeds --memory %dG with any chunk size, raise --memory",
+                               rss / 2**30, self.args.memory)
+
+    def _init_warmup(self):
+        self.warmup_lists = set()
+        if self.args.warmup:
+            shutil.rmtree(self.warmup_dir, ignore_errors=True)
+            mkdir(self.warmup_dir)
+
+    def _db_filelist(self, db, filelist):
+        if filelist not in self.warmup_lists:
+            mkdir(os.path.dirname(filelist))
+            files = blastdb_files(db, blast_dbtype[os.path.basename(self.btype)])
+            with open(filelist, "w") as fo:
+                fo.writelines(f + "\n" for f in files)
+            self.warmup_lists.add(filelist)
+        return filelist
+
+    def cache_blast_db(self, db, name):
+        if not self.args.warmup:
+            return ""
+        filelist = self._db_filelist(
+            db, os.path.join(self.warmup_dir, name + ".txt"))
+        return shlex.join([sys.executable, "-m", __package__ + ".warmup", "--budget",
+                           str(human_size_parse(self.args.warmup_mem)), filelist])
+
+    def _warmup_report(self):
+        for f in sorted(glob.glob(os.path.join(self.warmup_dir, "*.json"))):
+            with open(f) as fi:
+                w = json.load(fi)
+            self.loger.info("warmup %s on node %s: %d files, %.1fM cached in %.1fs (%s)",
+                            w["db"], w["host"], w["files"], w["bytes"] / 2**20, w["seconds"], w["method"])
+
+    def _chunk_result(self, fa, n):
+        name = os.path.basename(fa).split(".")
+        return os.path.join(self.tempdir, "results", chunk_bucket(int(name[1])), f"result.db_{n}.{name[1]}")
+
+    def _extra_result(self, result, k):
+        return "%s.fmt%d" % (result, k)
+
+    def _raw_result(self, result):
+        return self.args.dedup and result + ".dedup" or result
+
+    def _shard_db(self):
+        dbtype = blast_dbtype[os.path.basename(self.btype)]
+        pin = "-dbsize" not in self.blast_options and "-searchsp" not in self.blast_options
+        if self.args.merge_dbs and len(self.db) > 1:
+            self.merge_dbsize = pin and sum(blastdb_info(os.path.abspath(db), dbtype)[1]
+                                            for db in self.db) or 0
+            self.loger.info("merge hits of %d databases, effective db size: %s",
+                            len(self.db), self.merge_dbsize or "user defined")
+        if self.args.db_shards is None:
+            return
+        for n, db in enumerate(self.db):
+            db = os.path.abspath(db)
+            vols = blastdb_volumes(db, dbtype)
+            k = min(self.args.db_shards or len(vols), len(vols))
+            if k < 2:
+                continue
+            shards = [" ".join(vols[len(vols)*i//k:len(vols)*(i+1)//k])
+                      for i in range(k)]
+            dbsize = pin and blastdb_info(db, dbtype)[1] or 0
+            self.db_shards[n] = (shards, dbsize)
+            self.loger.info("shard db %s into %d shards (%d volumes), effective db size: %s",
+                            db, k, len(vols), dbsize or "user defined")
+
+    def _blast_cmd(self, fa, n, shard=None):
+        out = self._raw_result(self._chunk_result(fa, n))
+        db = os.path.abspath(self.db[n])
+        name = "db_%d" % n
+        cmdline = [self.blast_exe, ] + self.blast_options
+        dbsize = self.merge_dbsize
+        if shard is not None:
+            shards, size = self.db_shards[n]
+            out, db = out + ".%03d" % shard, shards[shard]
+            name += ".%03d" % shard
+            dbsize = dbsize or size
+        if dbsize:
+            cmdline.extend(["-dbsize", str(dbsize)])
+        cmdline.extend(["-out", out, "-query", fa, "-db", db])
+        if self.args.compress_results:
+            cmdline = [sys.executable, "-m", __package__ +
+                       ".compress", "--"] + cmdline
+        if self.args.scratch:
+            stage = [sys.executable, "-m", __package__ +
+                     ".scratch", "--scratch", self.args.scratch]
+            if self.args.scratch_db:
+                stage.extend(["--db-files", self._db_filelist(
+                    db, os.path.join(self.tempdir, "scratch", name + ".txt"))])
+            cmdline = stage + ["--"] + cmdline
+        if self.extra_formats:
+            stage = [sys.executable, "-m", __package__ +
+                     ".formatter", "--formatter", self.formatter]
+            for k, (fmt, _) in enumerate(self.extra_formats):
+                stage.extend(["--extra", fmt, self._extra_result(out, k)])
+            cmdline = stage + ["--"] + cmdline
+        if self.resources:
+            self.resources.threads = int(
+                self._blast_option("-num_threads", self.args.cpu or 1))
+            self.resources.add(out, fa, db)
+        cmdline = [sys.executable, "-m", __package__ + ".measure",
+                   "--stats", out + ".stats", "--"] + cmdline
+        self.metrics.submit(out, fa, n, shard)
+        warmup = self.cache_blast_db(db, name)
+        return (warmup and warmup + " && " or "") + shlex.join(cmdline)
+
+    def _merged_result(self, fa):
+        name = os.path.basename(fa).split(".")
+        return os.path.join(self.tempdir, "results", chunk_bucket(int(name[1])), f"result.merged.{name[1]}")
+
+    def _chunk_cmds(self, fa):
         cmds = []
-        if vmtouch and blastdb_path:
-            for db in self.db:
-                cmd = "%s -db %s -dbtype %s -getvolumespath | xargs %s -tqm 5G 2> /dev/null" % (
-                    blastdb_path, db, blast_dbtype[os.path.basename(self.btype)], vmtouch)
-                cmds.append(cmd)
+        os.makedirs(os.path.dirname(self._chunk_result(fa, 0)), exist_ok=True)
+        merged = self.args.merge_dbs and len(self.db) > 1 and self._merged_result(fa)
+        if merged:
+            self.chunk_res.append(merged)
+            merged = self._raw_result(merged)
+            self.db_parts[merged] = []
+        for n in range(len(self.db)):
+            result = self._chunk_result(fa, n)
+            raw = self._raw_result(result)
+            if merged:
+                self.db_parts[merged].append(raw)
+                self.db_group[raw] = merged
+            else:
+                self.chunk_res.append(result)
+            for k, m in enumerate(self.extra_mergers):
+                m.results.append(self._extra_result(result, k))
+            self.result_chunk[raw] = (fa, n)
+            if raw in self.completed:
+                continue
+            if n not in self.db_shards:
+                cmds.append(self._blast_cmd(fa, n))
+                continue
+            shards = [raw + ".%03d" %
+                      i for i in range(len(self.db_shards[n][0]))]
+            self.shard_res[raw] = (fa, shards)
+            for i, r in enumerate(shards):
+                self.shard_parent[r] = raw
+                if r in self.completed:
+                    self.shard_done.add(r)
+                else:
+                    cmds.append(self._blast_cmd(fa, n, i))
         return cmds
 
+    def _merge_shards(self, result):
+        fa, shards = self.shard_res.pop(result, (None, None))
+        if not shards:
+            return
+        merge_hits(shards, result, fasta_ids(fa), self.outfmt_columns,
+                   sep=self.outfmt_sep,
+                   max_target_seqs=int(self._blast_option(
+                       "-max_target_seqs", 500)),
+                   evalue=float(self._blast_option("-evalue", 10)))
+        self.manifest.add("result", result)
+        self._result_ready(result)
+
+    def _merge_dbs(self, part):
+        merged = self.db_group[part]
+        with self.lock:
+            self.db_done.add(part)
+            if merged in self.db_merged or not self.db_done.issuperset(self.db_parts[merged]):
+                return
+            self.db_merged.add(merged)
+        merge_hits(self.db_parts[merged], merged, fasta_ids(self.result_chunk[part][0]), self.outfmt_columns,
+                   sep=self.outfmt_sep,
+                   max_target_seqs=int(self._blast_option(
+                       "-max_target_seqs", 500)),
+                   evalue=float(self._blast_option("-evalue", 10)))
+        self.manifest.add("result", merged)
+        self._result_ready(merged)
+
+    def _result_ready(self, raw):
+        if raw in self.db_group:
+            return self._merge_dbs(raw)
+        if self.args.dedup:
+            with self.lock:
+                if not self.split_done:
+                    return self.deferred.append(raw)
+        if self.cache and os.path.isfile(raw):
+            self._cache_result(raw)
+        if not self.args.dedup:
+            for k, m in enumerate(self.extra_mergers):
+                m.finish(self._extra_result(raw, k))
+            return self.merger.finish(raw)
+        result = raw[:-len(".dedup")]
+        if os.path.isfile(raw):
+            fanout_hits(raw, result, self.dedup_dups, self.outfmt_columns.index("qseqid"),
+                        sep=self.outfmt_sep)
+        self.merger.finish(result)
+
+    def _job_success(self, job):
+        result = cmd_output(job.raw_cmd)
+        if result:
+            self._result_success(result)
+
+    def _job_error(self, job):
+        self.resources.failed(cmd_output(job.raw_cmd))
+
+    def _resources_report(self):
+        if self.resources and self.resources.peak:
+            self.loger.info("auto resources: peak memory of chunk jobs %.2fG, up to %dG requested",
+                            self.resources.peak / 2**30, max(map(self.resources.memory, self.resources.features)))
+
+    def _result_success(self, result):
+        if self.resources:
+            rss = [r["rss"] for r in read_stats(
+                result + ".stats") if r.get("exit") == 0]
+            if rss:
+                self.resources.learn(result, rss[-1])
+        for k in range(len(self.extra_formats)):
+            if os.path.isfile(self._extra_result(result, k)):
+                self.manifest.add("result", self._extra_result(result, k))
+        self.manifest.add("result", result)
+        if result in self.shard_parent:
+            self.shard_done.add(result)
+            parent = self.shard_parent[result]
+            if parent in self.shard_res and self.shard_done.issuperset(self.shard_res[parent][1]):
+                self._merge_shards(parent)
+        else:
+            self._result_ready(result)
+
     def write_blast_sh(self, out="hpc_blast.sh"):
         self.blast_scripts = os.path.join(self.tempdir, out)
         self._quotation_outfmt()
+        self._shard_db()
+        self._init_warmup()
         with open(self.blast_scripts, "w") as fo:
-            for n, db in enumerate(self.db):
-                db = os.path.abspath(db)
-                for fa in self.chunk_files:
-                    if not os.path.getsize(fa):
-                        continue  # ignore empty query file
-                    name = os.path.basename(fa).split(".")
-                    result = os.path.join(
-                        self.tempdir, "results", f"result.db_{n}.{name[1]}")
-                    self.chunk_res.append(result)
-                    cmdline = [self.blast_exe, ] + self.blast_options
-                    cmdline.extend(["-out", result, "-query", fa, "-db", db])
-                    fo.write(shlex.join(cmdline)+"\n")
-
-    def run_blast(self):
+            for fa in self.chunk_files:
+                if not os.path.getsize(fa):
+                    continue  # ignore empty query file
+                for cmd in self._chunk_cmds(fa):
+                    fo.write(cmd+"\n")
+
+    def _runjob_conf(self):
         mkdir(os.path.join(self.tempdir, "results"))
+        mkdir(self.args.logdir)
         self.args.jobfile = self.blast_scripts
-        # self.args.force = True  # force to resubmit
+        self.args.force = True  # results already verified by manifest
         conf = Config()
         conf.update_dict(**self.args.__dict__)
+        return conf
+
+    def _local_pool(self):
+        mkdir(os.path.join(self.tempdir, "results"))
+        mkdir(self.args.logdir)
+        threads = int(self._blast_option("-num_threads", self.args.cpu or 1))
+        memory = self.args.pool_mem and human_size_parse(
+            self.args.pool_mem) or mem_available()
+        return LocalPool(self.args.logdir, cores=self.args.pool_cores or 0, memory=memory,
+                         job_cores=threads, job_memory=self.args.memory * 2**30, numa=self.args.numa,
+                         maxjob=self.args.num or 0, retry=max(self.args.retry, 0), on_success=self._job_success,
+                         resources=self.resources, on_error=self.resources and self._job_error, logger=self.loger)
+
+    def _array_job(self, on_success=None):
+        self._runjob_conf()
+        return ArrayJob(self.blast_scripts, self.args.logdir, mode=self.args.mode,
+                        cpu=self.args.cpu, memory=self.args.memory, queue=self.args.queue, num=self.args.num or 0,
+                        retry=max(self.args.retry, 0), on_success=on_success, resources=self.resources,
+                        on_error=self.resources and self._job_error, logger=self.loger)
+
+    def run_blast(self, on_success=None):
+        on_success = on_success or self._job_success
         if os.path.isfile(self.blast_scripts):
-            mkdir(os.path.join(self.tempdir, "logs"))
-            job = runsge(config=conf)
+            if self.args.array:
+                job = self._array_job(on_success)
+            elif self.args.pool:
+                job = self._local_pool()
+                job.on_success = on_success
+                with open(self.blast_scripts) as fi:
+                    for cmd in fi:
+                        if cmd.strip():
+                            job.add_cmd(cmd.strip())
+                job.close()
+            else:
+                job = BlastRunJob(config=self._runjob_conf(), on_success=on_success, resources=self.resources,
+                                  on_error=self.resources and self._job_error)
+            try:
+                job.run()
+            finally:
+                job.on_success = job.on_error = None
+
+    def run_pipeline(self, out="hpc_blast.sh"):
+        self.blast_scripts = os.path.join(self.tempdir, out)
+        self._quotation_outfmt()
+        self._shard_db()
+        mkdir(self.tempdir)
+        self._init_warmup()
+        open(self.blast_scripts, "w").close()
+        job = self.args.pool and self._local_pool() or PipeRunJob(
+            config=self._runjob_conf(), on_success=self._job_success, resources=self.resources,
+            on_error=self.resources and self._job_error)
+        self.on_chunk = lambda fa: [job.add_cmd(cmd)
+                                    for cmd in self._chunk_cmds(fa)]
+        err = []
+
+        def _split():
+            try:
+                self.split_query()
+            except Exception as e:
+                err.append(e)
+            finally:
+                job.close()
+        t = Thread(target=_split, daemon=True)
+        t.start()
+        try:
             job.run()
+        finally:
+            t.join()
+            self.on_chunk = job.on_success = job.on_error = None
+        if err:
+            raise err[0]
 
-    def mergs_res(self, block_size=65536):
+    def run_dynamic(self, out="hpc_blast.sh"):
+        self._quotation_outfmt()
+        self._shard_db()
+        mkdir(self.tempdir)
+        self._init_warmup()
+        queue = WorkQueue(os.path.join(self.tempdir, "queue"), factor=self.args.straggler,
+                          retry=max(self.args.retry, 0), logger=self.loger)
+        queue.reset()
+        self.blast_scripts = os.path.join(self.tempdir, out)
+        worker = shlex.join([sys.executable, "-m", __package__ +
+                            ".worker", queue.path])
+        with open(self.blast_scripts, "w") as fo:
+            fo.writelines(worker + "\n" for _ in range(self.args.dynamic))
+        if self.args.pool:
+            job = self._local_pool()
+            for _ in range(self.args.dynamic):
+                job.add_cmd(worker)
+            job.close()
+        elif self.args.array:
+            job = self._array_job()
+        else:
+            job = BlastRunJob(config=self._runjob_conf())
+        self.on_chunk = lambda fa: [queue.put([cmd])
+                                    for cmd in self._chunk_cmds(fa)]
+        err = []
+
+        def _split():
+            try:
+                if self.split_done:
+                    for fa in self.chunk_files:
+                        if os.path.getsize(fa):
+                            self.on_chunk(fa)
+                else:
+                    self.split_query()
+            except Exception as e:
+                err.append(e)
+                queue.stop()
+            finally:
+                queue.close()
+        threads = [Thread(target=_split, daemon=True), Thread(
+            target=queue.monitor, args=(self._result_success,), daemon=True)]
+        for t in threads:
+            t.start()
+        try:
+            job.run()
+        finally:
+            queue.stop()
+            for t in threads:
+                t.join()
+            self.on_chunk = job.on_success = job.on_error = None
+        if err:
+            raise err[0]
+        if queue.failed or queue.pending:
+            raise JobFailedError("%d chunk tasks failed and %d unfinished, please check in %s" % (
+                len(queue.failed), len(queue.pending), self.args.logdir))
+
+    def mergs_res(self):
         if self.chunk_res:
+            self.metrics.start("merge")
             self.loger.info("gather all chunk results")
-            with open(self.outfile, "wb") as fo:
-                for f in self.chunk_res:
-                    with open(f, "rb") as fi:
-                        shutil.copyfileobj(fi, fo)
+            for result in self.chunk_res:
+                raw = self._raw_result(result)
+                for part in self.db_parts.get(raw, [raw]):
+                    if part in self.shard_res:
+                        self._merge_shards(part)
+                    elif result not in self.merger.done:
+                        self._result_ready(part)
+            self.merger.close()
+            for m in self.extra_mergers:
+                m.close()
+            if self.cache:
+                self.cache.close()
+            self.metrics.stop("merge")
             self.loger.info("hpc blast finished")
             self.finished = True
 
-    def run(self):
+    def _manifest_header(self):
+        dbtype = blast_dbtype[os.path.basename(self.btype)]
+        dbs = [blastdb_fingerprint(os.path.abspath(db), dbtype)
+               for db in self.db]
+        blast = [os.path.basename(self.btype),
+                 blast_options_key(self.blast_options)]
+        return json.loads(json.dumps({
+            "query": self.query != "-" and file_fingerprint(self.query) or None,
+            "split": [self.args.auto, self.args.split, self.args.size, self.args.filesize,
+                      self.args.balance, self.args.dedup,
+                      self.args.cache and [os.path.abspath(self.args.cache)] + blast + dbs or None],
+            "blast": blast + [self.args.db_shards, self.args.merge_dbs] + dbs}))
+
+    def _resume(self):
+        mkdir(self.tempdir)
+        header = self._manifest_header()
+        m = self.manifest.load()
+        chunks = [os.path.join(self.tempdir, f) for f in m.chunks]
+        ids = os.path.join(self.tempdir, "chunks", "dedup.ids")
+        if not header["query"] or m.header.get("query") != header["query"] or m.header.get("split") != header["split"] or \
+                not m.split_done or (self.args.dedup and not os.path.isfile(ids)) or \
+                not all(m.verify("chunk", fa) for fa in chunks):
+            for d in ["chunks", "results"]:
+                shutil.rmtree(os.path.join(self.tempdir, d),
+                              ignore_errors=True)
+            m.header, m.chunks, m.results, m.split_done = header, {}, {}, False
+            m.save()
+            return False
+        if m.header.get("blast") != header["blast"]:
+            m.results = {}
+        resdir = os.path.join(self.tempdir, "results")
+        m.results = {f: r for f, r in m.results.items()
+                     if m.verify("result", os.path.join(self.tempdir, f))}
+        m.header = header
+        m.save()
+        self.chunk_files = chunks
+        self.completed = {os.path.join(self.tempdir, f) for f in m.results}
+        self.completed = {r for r in self.completed if all(self._extra_result(r, k) in self.completed
+                                                           for k in range(len(self.extra_formats)))}
+        if self.args.dedup:
+            self.dedup_dups = load_dups(ids)
+        self._init_cache()
+        cached = os.path.join(resdir, "result.cache")
+        if cached in self.completed:
+            self.chunk_res.append(cached)
+            self.merger.finish(cached)
+        with self.lock:
+            self.split_done = True
+        self.loger.info("resume from %s: %d chunks, %d results already completed",
+                        m.path, len(chunks), len(self.completed))
+        return True
+
+    def split_query(self):
+        self.metrics.start("split")
+        self._init_cache()
+        if self.cache:
+            mkdir(os.path.join(self.tempdir, "results"))
+            self.cache_file = open(os.path.join(
+                self.tempdir, "results", "result.cache"), "wb")
         if self.args.size:
             self.split_fastx_by_seqnum(self.args.size)
         elif self.args.filesize:
             filesize = human_size_parse(self.args.filesize)
             self.split_fastx_by_filesize(filesize)
+        elif self.args.balance == "residues":
+            self.split_fastx_by_residues(self.args.split)
         else:
             self.split_fastx_by_part(self.args.split)
-        self.write_blast_sh()
-        self.run_blast()
-        self.mergs_res()
+        self._close_cache()
+        with self.lock:
+            self.split_done, deferred = True, self.deferred
+        if self.args.dedup:
+            self.loger.info("dedup %d query records into %d unique sequences (%.1f%% duplicates)",
+                            self.dedup_total, len(self.dedup_index),
+                            self.dedup_total and 100.0 * (self.dedup_total - len(self.dedup_index)) / self.dedup_total or 0.0)
+            self.dedup_index = {}
+            dump_dups(os.path.join(self.tempdir, "chunks",
+                      "dedup.ids"), self.dedup_dups)
+        self.manifest.add("split")
+        self.metrics.stop("split")
+        for raw in deferred:
+            self._result_ready(raw)
+
+    def _metrics_report(self):
+        try:
+            report = self.metrics.report(self.query, self.tempdir)
+        except OSError as e:
+            self.loger.warning("run metrics not reported: %s", e)
+            return
+        self.loger.info(metrics_summary(report))
+        return report
+
+    def _metrics_file(self):
+        return self.args.metrics or os.path.join(self.tempdir, "metrics.json")
+
+    def _dump_metrics(self, path, report, reports=None):
+        if not report:
+            return
+        try:
+            dump_metrics(path, report)
+            if self.args.metrics_prom:
+                dump_prom(self.args.metrics_prom, reports or [report])
+        except OSError as e:
+            self.loger.warning("run metrics not written: %s", e)
+
+    def run(self):
+        self._run()
+        self.clean_tempdir()
+
+    def _run(self):
+        try:
+            if self._resume():
+                self.metrics.start("blast")
+                if self.args.dynamic:
+                    self.run_dynamic()
+                else:
+                    self.write_blast_sh()
+                    self.run_blast()
+            else:
+                self.metrics.start("plan")
+                self.auto_plan()
+                self.metrics.stop("plan")
+                if self.args.dynamic or self.args.pipeline:
+                    self.metrics.start("blast")
+                    if self.args.dynamic:
+                        self.run_dynamic()
+                    else:
+                        self.run_pipeline()
+                else:
+                    self.split_query()
+                    self.metrics.start("blast")
+                    self.write_blast_sh()
+                    self.run_blast()
+            self.metrics.stop("blast")
+            self._warmup_report()
+            self._resources_report()
+            self.mergs_res()
+        finally:
+            self._dump_metrics(self._metrics_file(), self._metrics_report())
+
+    def iter_hits(self, numpy=False, batch_size=65536):
+        if self.outfmt not in ["6", "7", "10"]:
+            raise ArgumentsError("iter_hits requires tabular -outfmt 6/7/10")
+        if numpy and np is None:
+            raise ImportError("numpy is required by iter_hits(numpy=True)")
+        cols = self.outfmt_columns
+        Hit = hit_record(cols)
+        results, err = Queue(), []
+        self.merger.on_append = results.put
+
+        def _run():
+            try:
+                self._run()
+            except BaseException as e:
+                err.append(e)
+            finally:
+                results.put(None)
+        t = Thread(target=_run, daemon=True)
+        t.start()
+        for result in iter(results.get, None):
+            with open_result(result) as fi:
+                for rows in tabular_rows(fi, cols, self.outfmt_sep, batch_size):
+                    if numpy:
+                        yield hits_array(rows, cols)
+                    else:
+                        yield from (Hit(*r) for r in rows)
+        t.join()
+        self.merger.on_append = None
+        if err:
+            raise err[0]
+        self.clean_tempdir()
 
     def __del__(self):
-        tempath = ["chunks", "results", "logs", "hpc_blast.sh"]
+        self.clean_tempdir()
+
+    def clean_tempdir(self):
+        tempath = ["chunks", "results", "logs", "warmup", "scratch", "queue", "hpc_blast.sh", "manifest.jsonl"]
+        if self.cleandir:
+            tempath.append("metrics.json")
         try:
             if self.finished and os.path.isdir(self.tempdir):
                 for p in tempath:
                     path = os.path.join(self.tempdir, p)
                     if os.path.isdir(path):
                         shutil.rmtree(path)
-                    else:
+                    elif os.path.isfile(path):
                         os.remove(path)
                 else:
                     if not os.listdir(self.tempdir):
                         shutil.rmtree(self.tempdir)
         except:
             pass
+
+
+class HPCBlastBatch(object):
+
+    def __init__(self, args=None, blast_options=None):
+        self.args = args
+        self.outdir = os.path.abspath(getattr(args, "outfile", os.getcwd()))
+        self.tempdir = os.path.abspath(args.tempdir or tempfile.mktemp(
+            prefix="hpc-blast_", dir=self.outdir))
+        self.loger = log(args.log, "info")
+        if getattr(args, "outfile", None) == "-":
+            raise ArgumentsError("--batch can not write results to stdout")
+        if args.pipeline or args.dynamic or args.auto or args.extra_outfmt:
+            raise ArgumentsError(
+                "--batch can not be used with --pipeline, --dynamic, --auto or --extra-outfmt")
+        self.samples = []
+        self.owner = {}
+        self.blast_scripts = ""
+        self.finished = False
+        for i, (query, out) in enumerate(batch_queries(args.batch)):
+            a = copy.copy(args)
+            a.query, a.batch = query, None
+            a.outfile = out or os.path.join(
+                self.outdir, fastx_name(query) + ".blast")
+            a.tempdir = os.path.join(self.tempdir, "sample_%05d" % i)
+            s = HPCBlast(a, list(blast_options))
+            s.args.logdir = os.path.join(self.tempdir, "logs")
+            s.warmup_dir = os.path.join(self.tempdir, "warmup")
+            self.samples.append(s)
+        if not self.samples:
+            raise ArgumentsError("no query file found by --batch %s" % args.batch)
+        outs = [s.outfile for s in self.samples]
+        if len(set(outs)) < len(outs):
+            raise ArgumentsError(
+                "duplicate output files in --batch %s" % args.batch)
+        mkdir(self.outdir)
+
+    def _job_success(self, job):
+        result = cmd_output(job.raw_cmd)
+        if result in self.owner:
+            self.owner[result]._result_success(result)
+
+    def write_blast_sh(self, out="hpc_blast.sh"):
+        first = self.samples[0]
+        first._shard_db()
+        first._init_warmup()
+        cmds, dbs = [], {}
+        for s in self.samples:
+            s._quotation_outfmt()
+            s.db_shards, s.warmup_lists = first.db_shards, first.warmup_lists
+            s.merge_dbsize = first.merge_dbsize
+            s.resources = first.resources
+            mkdir(os.path.join(s.tempdir, "results"))
+            for fa in s.chunk_files:
+                if not os.path.getsize(fa):
+                    continue
+                for cmd in s._chunk_cmds(fa):
+                    c = shlex.split(cmd)
+                    self.owner[cmd_output(cmd)] = s
+                    cmds.append(
+                        (dbs.setdefault(c[c.index("-db")+1], len(dbs)), cmd))
+        cmds.sort(key=lambda x: x[0])
+        self.blast_scripts = first.blast_scripts = os.path.join(
+            self.tempdir, out)
+        with open(self.blast_scripts, "w") as fo:
+            fo.writelines(cmd + "\n" for _, cmd in cmds)
+
+    def run(self):
+        for s in self.samples:
+            if not s._resume():
+                s.split_query()
+        self.loger.info("batch of %d query files, %d chunks in total",
+                        len(self.samples), sum(len(s.chunk_files) for s in self.samples))
+        self.write_blast_sh()
+        for s in self.samples:
+            s.metrics.start("blast")
+        try:
+            self.samples[0].run_blast(on_success=self._job_success)
+            for s in self.samples:
+                s.metrics.stop("blast")
+            self.samples[0]._warmup_report()
+            self.samples[0]._resources_report()
+            for s in self.samples:
+                s.mergs_res()
+        finally:
+            reports = [r for r in (s._metrics_report()
+                                   for s in self.samples) if r]
+            self.samples[0]._dump_metrics(self.args.metrics or os.path.join(self.tempdir, "metrics.json"),
+                                          reports and {"samples": reports}, reports)
+        self.finished = all(s.finished for s in self.samples)
+        self.clean_tempdir()
+
+    def __del__(self):
+        self.clean_tempdir()
+
+    def clean_tempdir(self):
+        try:
+            if self.finished and os.path.isdir(self.tempdir):
+                for s in self.samples:
+                    s.clean_tempdir()
+                for p in ["logs", "warmup", "hpc_blast.sh"] + (not self.args.tempdir and ["metrics.json"] or []):
+                    path = os.path.join(self.tempdir, p)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.isfile(path):
+                        os.remove(path)
+                if not os.listdir(self.tempdir):
+                    shutil.rmtree(self.tempdir)
+        except:
+            pass
@@ -3,20 +3,56 @@
 import os
 import re
 import sys
+import glob
 import gzip
+import json
+import zlib
+import io
+import struct
+import mmap
+import heapq
+import random
+import bisect
 import shlex
+import resource
+import copy
 import shutil
+import statistics
+import sqlite3
+import hashlib
 import signal
+import time
 import tempfile
 import argparse
 import subprocess
 
+from queue import Queue, Empty
+from collections import deque, OrderedDict
+from operator import add
+from threading import Thread, Lock, current_thread, main_thread
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, chain, groupby, islice
 from runjob.parser import *
-from runjob import log, runsge
+from runjob.job import Job
+from runjob import log, runsge, JobQueue
 from runjob.config import Config
+from runjob.utils import JobFailedError
 
 from ._version import __version__
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 1 << 24
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
 
 class Zopen(object):
 
@@ -26,10 +62,18 @@ class Zopen(object):
         self.handler = None
 
     def __enter__(self):
-        if self.name.endswith(".gz"):
-            if "r" in self.mode:
+        if self.name == "-":
+            self.handler = sys.stdin.buffer
+            if self.handler.peek(2)[:2] == b"\x1f\x8b":
+                self.handler = gzip.GzipFile(fileobj=self.handler)
+        elif self.name.endswith(".gz"):
+            offsets = "r" in self.mode and gzip_offsets(self.name)
+            if offsets and len(offsets) > 2:
+                self.handler = io.BufferedReader(
+                    BgzfReader(self.name, offsets), BLOCK_SIZE)
+            elif "r" in self.mode:
                 p = subprocess.Popen(
-                    ["gzip", "-c", "-d", self.name], stdout=subprocess.PIPE)
+                    [which("pigz") and "pigz" or "gzip", "-c", "-d", self.name], stdout=subprocess.PIPE)
                 self.handler = p.stdout
             else:
                 self.handler = gzip.open(self.name, self.mode)
@@ -42,9 +86,192 @@ class Zopen(object):
             self.handler.close()
 
 
+class BgzfReader(io.RawIOBase):
+
+    def __init__(self, name, offsets, threads=None, block_size=BLOCK_SIZE):
+        cuts = [0]
+        for o in offsets[1:]:
+            if o - cuts[-1] >= block_size or o == offsets[-1]:
+                cuts.append(o)
+        self.name = name
+        self.ranges = list(zip(cuts, cuts[1:]))
+        self.threads = threads or min(len(os.sched_getaffinity(0)), 8)
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.blocks = self._inflate()
+        self.buf = b""
+        self.pos = 0
+
+    def _inflate(self):
+        ranges = iter(self.ranges)
+        self.pending.extend(self.pool.submit(inflate_range, self.name, *r)
+                            for r in islice(ranges, 2 * self.threads))
+        while self.pending:
+            data = self.pending.popleft().result()
+            for r in islice(ranges, 1):
+                self.pending.append(self.pool.submit(
+                    inflate_range, self.name, *r))
+            yield data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.buf):
+            self.buf, self.pos = next(self.blocks, None), 0
+            if self.buf is None:
+                self.buf = b""
+                return 0
+        n = min(len(b), len(self.buf) - self.pos)
+        b[:n] = memoryview(self.buf)[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+            for f in self.pending:
+                f.cancel()
+            self.pool.shutdown(wait=True)
+        super(BgzfReader, self).close()
+
+
+class BgzfWriter(object):
+
+    def __init__(self, name, threads=None, level=6, eof=True, block_size=1 << 22):
+        self.handler = open(name, "wb")
+        self.threads = threads or min(len(os.sched_getaffinity(0)), 8)
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.level = level
+        self.eof = eof
+        self.block_size = block_size
+        self.pending = deque()
+        self.buf = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        self.pending.append(self.pool.submit(
+            bgzf_compress, bytes(self.buf), self.level))
+        self.buf = bytearray()
+        while len(self.pending) > 2 * self.threads:
+            self.handler.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buf:
+            self._submit()
+        while self.pending:
+            self.handler.write(self.pending.popleft().result())
+        self.handler.flush()
+
+    def write_raw(self, fi, offset, count):
+        self.flush()
+        copy_range(fi, self.handler, offset, count)
+
+    def close(self):
+        if self.handler.closed:
+            return
+        try:
+            self.flush()
+            if self.eof:
+                self.handler.write(BGZF_EOF)
+        finally:
+            self.handler.close()
+            self.pool.shutdown()
+
+
+class CompressPipe(object):
+
+    def __init__(self, cmd, name):
+        self.name = name
+        self.handler = open(name, "wb")
+        self.proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=self.handler)
+
+    def write(self, data):
+        return self.proc.stdin.write(data)
+
+    def close(self):
+        if self.handler.closed:
+            return
+        self.proc.stdin.close()
+        rc = self.proc.wait()
+        self.handler.close()
+        if rc:
+            raise subprocess.CalledProcessError(rc, self.proc.args)
+
+
+class ChunkWriter(object):
+
+    def __init__(self, *outfiles, max_open=None, buffer_size=1 << 22, max_buffer=1 << 28):
+        self.outfiles = outfiles
+        self.max_open = max_open or max(
+            min(256, resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 4), 1)
+        self.buffer_size = buffer_size
+        self.max_buffer = max_buffer
+        self.buffers = {}
+        self.sizes = {}
+        self.buffered = 0
+        self.handlers = OrderedDict()
+        self.created = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for i in range(len(self.outfiles)):
+            self.close(i)
+
+    def write(self, i, data):
+        self.buffers.setdefault(i, []).append(data)
+        self.sizes[i] = self.sizes.get(i, 0) + len(data)
+        self.buffered += len(data)
+        if self.sizes[i] >= self.buffer_size:
+            self.flush(i)
+        elif self.buffered >= self.max_buffer:
+            for j in sorted(self.buffers):
+                self.flush(j)
+
+    def flush(self, i):
+        data = self.buffers.pop(i, None)
+        if not data:
+            return
+        self.buffered -= self.sizes.pop(i)
+        self._handler(i).write(b"".join(data))
+
+    def close(self, i):
+        self.flush(i)
+        fh = self.handlers.pop(i, None)
+        if fh is None and i not in self.created:
+            fh = self._handler(i)
+            self.handlers.pop(i)
+        if fh is not None:
+            fh.close()
+
+    def _handler(self, i):
+        fh = self.handlers.pop(i, None)
+        if fh is None:
+            if len(self.handlers) >= self.max_open:
+                self.handlers.popitem(last=False)[1].close()
+            fh = open(self.outfiles[i], i in self.created and "ab" or "wb", buffering=0)
+            self.created.add(i)
+        self.handlers[i] = fh
+        return fh
+
+
 class MultiFileOpen(object):
 
-    def __init__(self, mode="rb", *infiles):
+    def __init__(self, *infiles, mode="rb"):
         self.info = infiles
         self.handler = {}
         self.mode = mode
@@ -62,16 +289,871 @@ class MultiFileOpen(object):
             h.close()
 
 
+class FastxReader(object):
+
+    def __init__(self, name, fx=None, block_size=BLOCK_SIZE):
+        self.name = name
+        self.fx = fx or get_fastx_type(name)
+        self.block_size = block_size
+        self.handler = None
+        self.mm = None
+        self._zopen = None
+
+    def __enter__(self):
+        if self.fx == "fasta" and self.name != "-" and not self.name.endswith(".gz") and os.path.getsize(self.name):
+            self.handler = open(self.name, "rb")
+            self.mm = mmap.mmap(self.handler.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        else:
+            self._zopen = Zopen(self.name, mode="rb")
+            self.handler = self._zopen.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self._zopen:
+            self._zopen.__exit__(exc_type, exc_val, exc_tb)
+        elif self.handler:
+            self.handler.close()
+
+    def __iter__(self):
+        if self.mm is not None:
+            return self._mmap_blocks()
+        elif self.fx == "fasta":
+            return self._fasta_blocks()
+        return self._fastq_blocks()
+
+    @property
+    def size(self):
+        if self.mm is not None:
+            return len(self.mm)
+
+    def next_record(self, pos):
+        if pos >= len(self.mm):
+            return len(self.mm)
+        if pos <= 0:
+            return max(self.mm.find(b">"), 0)
+        i = self.mm.find(b"\n>", pos - 1)
+        return i < 0 and len(self.mm) or i + 1
+
+    def _mmap_blocks(self):
+        s, size = self.next_record(0), len(self.mm)
+        while s < size:
+            e = self.next_record(s + self.block_size)
+            buf = self.mm[s:e]
+            if e == size and not buf.endswith(b"\n"):
+                buf += b"\n"
+            yield buf, fasta_offsets(buf)
+            s = e
+
+    def _fasta_blocks(self):
+        pending = []
+        while True:
+            data = self.handler.read(self.block_size)
+            if not data:
+                break
+            i = data.rfind(b"\n>")
+            if i < 0:
+                pending.append(data)
+                continue
+            pending.append(data[:i+1])
+            buf = b"".join(pending)
+            yield buf, fasta_offsets(buf)
+            pending = [data[i+1:], ]
+        buf = b"".join(pending)
+        if buf.strip():
+            if not buf.endswith(b"\n"):
+                buf += b"\n"
+            yield buf, fasta_offsets(buf)
+
+    def _fastq_blocks(self):
+        rest = [b"", ]
+        while True:
+            data = self.handler.read(self.block_size)
+            lines = data.split(b"\n")
+            lines[0] = rest.pop() + lines[0]
+            lines[:0] = rest
+            if not data:
+                while lines and not lines[-1].strip():
+                    lines.pop()
+                n = len(lines) // 4 * 4
+            else:
+                n = (len(lines) - 1) // 4 * 4
+            if n:
+                yield fastq2fasta(lines[:n])
+            if not data:
+                break
+            rest = lines[n:]
+
+
+class BlastRunJob(runsge):
+
+    def __init__(self, config=None, on_success=None, resources=None, on_error=None, **kwargs):
+        super(BlastRunJob, self).__init__(config=config, **kwargs)
+        self.on_success = on_success
+        self.resources = resources
+        self.on_error = on_error
+
+    def submit(self, job):
+        if self.resources:
+            job.mem, job.cpu = self.resources(job.raw_cmd)
+        super(BlastRunJob, self).submit(job)
+
+    def cleanup(self):
+        if current_thread() is main_thread():
+            super(BlastRunJob, self).cleanup()
+
+    def adjust_jobsgraph(self, jb, js):
+        if js == "error" and self.on_error:
+            self.on_error(jb)
+        super(BlastRunJob, self).adjust_jobsgraph(jb, js)
+        if js == "success" and self.on_success:
+            self.on_success(jb)
+
+
+class PipeRunJob(BlastRunJob):
+
+    sentinel = "hpc_blast_split"
+
+    def __init__(self, config=None, on_success=None, **kwargs):
+        super(PipeRunJob, self).__init__(
+            config=config, on_success=on_success, **kwargs)
+        self.cmds = Queue()
+        self.maxjob = int(self.conf.num or 1000)
+        self.jobqueue = JobQueue(maxsize=min(max(self.maxjob, 1), 1000))
+        self.jobsgraph.add_node_if_not_exists(self.sentinel)
+
+    def add_cmd(self, cmd):
+        self.cmds.put(cmd)
+
+    def close(self):
+        self.cmds.put(None)
+
+    def _add_job(self, cmd):
+        with open(self.jfile._path, "a") as fo:
+            fo.write(cmd + "\n")
+        job = Job(self.conf).from_cmd(
+            self.jfile, linenum=len(self.jfile.totaljobs), cmd=cmd)
+        if os.path.isfile(job.logfile):
+            os.remove(job.logfile)
+        job.status = "wait"
+        self.jfile.totaljobs[job.name] = job
+        self.totaljobdict[job.jobname] = job
+        self.jobs.append(job)
+        self.jobsgraph.add_node_if_not_exists(job.jobname)
+        return job.jobname
+
+    def pending_jobs(self, *names):
+        names = [n for n in names if n in self.totaljobdict]
+        while True:
+            try:
+                cmd = self.cmds.get_nowait()
+            except Empty:
+                break
+            if cmd is None:
+                self.jobsgraph.delete_node_if_exists(self.sentinel)
+            else:
+                names.append(self._add_job(cmd))
+        return super(PipeRunJob, self).pending_jobs(*names)
+
+
+class PoolJob(object):
+
+    __slots__ = ("name", "raw_cmd", "cores", "memory", "logfile", "proc", "start")
+
+    def __init__(self, name, raw_cmd, cores, logfile):
+        self.name = name
+        self.raw_cmd = raw_cmd
+        self.cores = cores
+        self.memory = 0
+        self.logfile = logfile
+        self.proc = None
+        self.start = time.time()
+
+
+class LocalPool(object):
+
+    def __init__(self, logdir, cores=0, memory=0, job_cores=1, job_memory=0, numa=False, maxjob=0, retry=0,
+                 on_success=None, resources=None, on_error=None, logger=None):
+        avail = sorted(os.sched_getaffinity(0))
+        self.cores = avail[:cores or len(avail)]
+        groups = [self.cores]
+        if numa:
+            groups = [[c for c in cpus if c in self.cores]
+                      for cpus in numa_nodes().values()] or groups
+        self.free = [g for g in groups if g]
+        self.groups = [set(g) for g in self.free]
+        self.job_cores = max(min(job_cores, max(map(len, self.free))), 1)
+        self.memory = memory
+        self.job_memory = job_memory
+        self.used_memory = 0
+        self.maxjob = maxjob
+        self.retry = retry
+        self.logdir = logdir
+        self.on_success = on_success
+        self.on_error = on_error
+        self.resources = resources
+        self.loger = logger
+        self.taskset = shutil.which("taskset")
+        self.events = Queue()
+        self.pending = deque()
+        self.running = {}
+        self.tries = {}
+        self.jobs = 0
+        self.failed = []
+
+    def add_cmd(self, cmd):
+        self.events.put(("cmd", cmd))
+
+    def close(self):
+        self.events.put(("cmd", None))
+
+    def _job_memory(self, cmd):
+        if self.resources:
+            return self.resources(cmd)[0] << 30
+        return self.job_memory
+
+    def _alloc(self, memory):
+        if self.maxjob and len(self.running) >= self.maxjob:
+            return
+        if self.running and self.memory and self.used_memory + memory > self.memory:
+            return
+        fits = [g for g in self.free if len(g) >= self.job_cores]
+        if not fits:
+            return
+        g = min(fits, key=len)
+        cores, g[:] = g[:self.job_cores], g[self.job_cores:]
+        self.used_memory += memory
+        return cores
+
+    def _release(self, job):
+        i = next(i for i, g in enumerate(self.groups) if job.cores[0] in g)
+        self.free[i].extend(job.cores)
+        self.free[i].sort()
+        self.used_memory -= job.memory
+
+    def _start(self, cmd, cores, memory):
+        self.jobs += 1
+        name = "hpc_blast_%05d" % self.jobs
+        job = PoolJob(name, cmd, cores, os.path.join(
+            self.logdir, name + ".log"))
+        job.memory = memory
+        argv = ["/bin/sh", "-c", cmd]
+        if self.taskset:
+            argv = [self.taskset, "-c", ",".join(map(str, cores))] + argv
+        with open(job.logfile, "wb") as logf:
+            job.proc = subprocess.Popen(
+                argv, stdout=logf, stderr=subprocess.STDOUT)
+        if not self.taskset:
+            os.sched_setaffinity(job.proc.pid, cores)
+        self.running[name] = job
+        Thread(target=lambda: self.events.put(
+            ("done", job, job.proc.wait())), daemon=True).start()
+
+    def _finish(self, job, rc):
+        del self.running[job.name]
+        self._release(job)
+        status = rc and "failed" or "success"
+        if self.loger:
+            self.loger.info("job %s %s (exit %d) in %.1fs on cores %s, %d running",
+                            job.name, status, rc, time.time() - job.start,
+                            ",".join(map(str, job.cores)), len(self.running))
+        if not rc:
+            if self.on_success:
+                self.on_success(job)
+            return
+        if self.on_error:
+            self.on_error(job)
+        n = self.tries[job.raw_cmd] = self.tries.get(job.raw_cmd, 0) + 1
+        if n > self.retry:
+            self.failed.append(job)
+            return
+        if self.loger:
+            self.loger.info("retry failed job %s (%d/%d)",
+                            job.name, n, self.retry)
+        self.pending.append(job.raw_cmd)
+
+    def run(self):
+        closed = False
+        try:
+            while not closed or self.pending or self.running:
+                kind, *ev = self.events.get()
+                if kind == "done":
+                    self._finish(*ev)
+                elif ev[0] is None:
+                    closed = True
+                else:
+                    self.pending.append(ev[0])
+                while self.pending:
+                    memory = self._job_memory(self.pending[0])
+                    cores = self._alloc(memory)
+                    if not cores:
+                        break
+                    self._start(self.pending.popleft(), cores, memory)
+        finally:
+            for job in self.running.values():
+                job.proc.terminate()
+        if self.failed:
+            raise JobFailedError("%d jobs %s failed, please check in logs: %s" % (
+                len(self.failed), [j.name for j in self.failed], [j.logfile for j in self.failed]))
+
+
+class ArrayJob(object):
+
+    script = """#!/bin/bash
+i=${{SGE_TASK_ID:-$SLURM_ARRAY_TASK_ID}}
+stat={stat}.$i
+cmd=$(sed -n "${{i}}p" {cmdfile})
+echo "[$(date +'%F %T')] RUNNING: $cmd"
+/bin/bash -euo pipefail -c "$cmd" && touch $stat.success || {{ touch $stat.error; exit 1; }}
+"""
+
+    def __init__(self, jobfile, logdir, mode="sge", cpu=1, memory=1, queue=None, num=0, retry=0, poll=5.0,
+                 on_success=None, resources=None, on_error=None, logger=None):
+        self.jobfile = jobfile
+        self.logdir = logdir
+        self.mode = mode
+        self.cpu = cpu
+        self.memory = memory
+        self.queue = queue or []
+        self.num = num
+        self.retry = retry
+        self.poll = poll
+        self.on_success = on_success
+        self.resources = resources
+        self.on_error = on_error
+        self.loger = logger
+        self.name = "hpc_blast_%d" % os.getpid()
+        self.jobid = None
+
+    def _submit(self, script, n, memory, cpu):
+        if self.mode == "slurm":
+            cmd = ["sbatch", "--parsable", "--job-name", self.name, "--array", "1-%d%s" % (n, self.num and "%%%d" % self.num or ""),
+                   "--ntasks-per-node", str(cpu), "--mem", "%dG" % memory,
+                   "--output", os.path.join(self.logdir, self.name + "_%a.log")]
+            if self.queue:
+                cmd.extend(["--partition", ",".join(self.queue)])
+        else:
+            cmd = ["qsub", "-terse", "-V", "-cwd", "-N", self.name, "-j", "y", "-S", "/bin/bash", "-t", "1-%d" % n,
+                   "-o", os.path.join(self.logdir, self.name + ".$TASK_ID.log"),
+                   "-l", "vf=%dg,p=%d" % (memory, cpu)]
+            if self.num:
+                cmd.extend(["-tc", str(self.num)])
+            for q in self.queue:
+                cmd.extend(["-q", q])
+        out = subprocess.check_output(cmd + [script]).decode().strip()
+        return re.split(r"[.;]", out)[0]
+
+    def alive(self):
+        if self.mode == "slurm":
+            p = subprocess.run(["squeue", "-h", "-j", self.jobid],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            return p.returncode == 0 and bool(p.stdout.strip())
+        return subprocess.call(["qstat", "-j", self.jobid], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def kill(self):
+        if self.jobid:
+            subprocess.call([self.mode == "slurm" and "scancel" or "qdel", self.jobid],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _run_array(self, cmds, n):
+        statdir = os.path.join(self.logdir, "array.%d" % n)
+        mkdir(statdir)
+        cmdfile = os.path.join(self.logdir, "array.%d.cmd" % n)
+        script = os.path.join(self.logdir, "array.%d.sh" % n)
+        with open(cmdfile, "w") as fo:
+            fo.writelines(c + "\n" for c in cmds)
+        with open(script, "w") as fo:
+            fo.write(self.script.format(stat=os.path.join(
+                statdir, "task"), cmdfile=cmdfile))
+        memory, cpu = self.memory, self.cpu
+        for c in self.resources and cmds or []:
+            m, p = self.resources(c)
+            memory, cpu = max(memory, m), max(cpu, p)
+        self.jobid = self._submit(script, len(cmds), memory, cpu)
+        if self.loger:
+            self.loger.info("submit array job %s with %d tasks",
+                            self.jobid, len(cmds))
+        status, live = {}, True
+        while len(status) < len(cmds):
+            if not live:
+                status.update((i, "error") for i in range(len(cmds)) if i not in status)
+                break
+            live = self.alive()
+            for f in os.listdir(statdir):
+                i, st = f.split(".")[1:]
+                i = int(i) - 1
+                if i in status:
+                    continue
+                status[i] = st
+                if st == "success" and self.on_success:
+                    self.on_success(PoolJob("%s.%d" % (self.jobid, i + 1), cmds[i], None, os.path.join(
+                        self.logdir, self.name + (self.mode == "slurm" and "_%d.log" or ".%d.log") % (i + 1))))
+            if len(status) < len(cmds):
+                time.sleep(self.poll)
+        self.jobid = None
+        failed = [i for i in range(len(cmds)) if status[i] != "success"]
+        for i in self.on_error and failed or []:
+            self.on_error(PoolJob("%s.%d" % (self.name, i + 1), cmds[i], None, None))
+        return failed
+
+    def run(self):
+        with open(self.jobfile) as fi:
+            cmds = [c.strip() for c in fi if c.strip()]
+        n = 0
+        try:
+            while cmds:
+                failed = self._run_array(cmds, n)
+                cmds, n = [cmds[i] for i in failed], n + 1
+                if cmds and n > self.retry:
+                    raise JobFailedError("%d array tasks failed, please check in logs: %s" % (
+                        len(cmds), self.logdir))
+                if cmds and self.loger:
+                    self.loger.info(
+                        "resubmit %d failed array tasks", len(cmds))
+        finally:
+            self.kill()
+
+
+class WorkQueue(object):
+
+    def __init__(self, path, factor=3.0, retry=0, poll=1.0, logger=None):
+        self.path = path
+        self.factor = factor
+        self.retry = retry
+        self.poll = poll
+        self.loger = logger
+        self.tasks = {}
+        self.copies = {}
+        self.fails = {}
+        self.started = {}
+        self.done = {}
+        self.failed = []
+        self.closed = False
+        self.lock = Lock()
+
+    def _dir(self, *name):
+        return os.path.join(self.path, *name)
+
+    def reset(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        for d in ["tasks", "todo", "claimed", "won", "done", "failed"]:
+            mkdir(self._dir(d))
+
+    def put(self, cmds):
+        if not cmds:
+            return
+        with self.lock:
+            tid = "%08d" % len(self.tasks)
+            self.tasks[tid] = [cmd_output(c) for c in cmds]
+        with open(self._dir("tasks", tid + ".json"), "w") as fo:
+            json.dump({"cmds": cmds}, fo)
+        self._ticket(tid)
+
+    def _ticket(self, tid):
+        spec = self.copies[tid] = self.copies.get(tid, 0) + 1
+        open(self._dir("todo", "%d-%s.%d" %
+             (spec == 1, tid, spec)), "w").close()
+
+    def close(self):
+        self.closed = True
+
+    def stop(self):
+        open(self._dir("stop"), "w").close()
+
+    @property
+    def stopped(self):
+        return os.path.exists(self._dir("stop"))
+
+    @property
+    def pending(self):
+        return [tid for tid in self.tasks if tid not in self.done and tid not in self.failed]
+
+    def monitor(self, on_done):
+        while not self.stopped:
+            for f in os.listdir(self._dir("done")):
+                tid = f[:-5]
+                if not f.endswith(".json") or tid in self.done:
+                    continue
+                with open(self._dir("done", f)) as fi:
+                    info = json.load(fi)
+                self.done[tid] = info["seconds"]
+                if info["copy"] > 1 and self.loger:
+                    self.loger.info("chunk task %s won by copy %d on %s in %.1fs",
+                                    tid, info["copy"], info["worker"], info["seconds"])
+                for out in self.tasks[tid]:
+                    on_done(out)
+            self._check_failed()
+            self._speculate()
+            with self.lock:
+                if self.closed and not self.pending:
+                    break
+            time.sleep(self.poll)
+        self.stop()
+
+    def _check_failed(self):
+        for f in sorted(os.listdir(self._dir("failed"))):
+            ticket = f[:-5]
+            tid = ticket.split("-", 1)[1].rsplit(".", 1)[0]
+            os.remove(self._dir("failed", f))
+            if tid in self.done or tid in self.failed:
+                continue
+            self.fails[tid] = self.fails.get(tid, 0) + 1
+            if self.fails[tid] > self.retry:
+                self.failed.append(tid)
+            else:
+                self._ticket(tid)
+
+    def _speculate(self):
+        now = time.time()
+        running = set(os.listdir(self._dir("claimed")))
+        for ticket in running - set(self.started):
+            self.started[ticket] = now
+        if len(self.done) < 3:
+            return
+        median = statistics.median(self.done.values())
+        for ticket in running:
+            tid = ticket.split("-", 1)[1].rsplit(".", 1)[0]
+            age = now - self.started[ticket]
+            if tid in self.done or self.copies[tid] > 1 or age <= self.factor * max(median, self.poll):
+                continue
+            self._ticket(tid)
+            if self.loger:
+                self.loger.info("chunk task %s running %.1fs (median %.1fs), launch a speculative copy",
+                                tid, age, median)
+
+
+class ResultMerger(object):
+
+    def __init__(self, outfile, results, outfmt="0"):
+        self.outfile = outfile
+        self.results = results
+        self.outfmt = outfmt
+        self.done = set()
+        self.pos = 0
+        self.head = True
+        self.footer = b""
+        self.queries = 0
+        self.iterations = 0
+        self.handler = None
+        self.on_append = None
+        self.lock = Lock()
+
+    def finish(self, *results):
+        with self.lock:
+            self.done.update(results)
+            while self.pos < len(self.results) and self.results[self.pos] in self.done:
+                self._append(self.results[self.pos])
+                self.pos += 1
+
+    def close(self):
+        self.finish(*self.results)
+        with self.lock:
+            if self.handler is None:
+                self.handler = open_output(self.outfile)
+            if self.outfmt == "7" and self.queries:
+                self.footer = b"# BLAST processed %d queries\n" % self.queries
+            self.handler.write(self.footer)
+            self.handler.close()
+
+    def _footer(self, footer):
+        if self.outfmt == "7":
+            n = re.match(rb"# BLAST processed (\d+)", footer)
+            self.queries += n and int(n.group(1)) or 0
+        else:
+            self.footer = footer
+
+    def _append_gzip(self, fi, size):
+        if self.outfmt in ["6", "10"] and isinstance(self.handler, BgzfWriter):
+            return self.handler.write_raw(fi, 0, size)
+        with gzip.GzipFile(fileobj=fi) as gz:
+            tail = b""
+            for block in iter(lambda: gz.read(BLOCK_SIZE), b""):
+                tail += block
+                if len(tail) > 1 << 16:
+                    self.handler.write(tail[:-(1 << 16)])
+                    tail = tail[-(1 << 16):]
+            e = outfmt_span(tail, self.outfmt)[1]
+            self._footer(tail[e:])
+            self.handler.write(tail[:e])
+
+    def _append(self, result):
+        if self.handler is None:
+            self.handler = open_output(self.outfile)
+        with open(result, "rb") as fi:
+            size = os.fstat(fi.fileno()).st_size
+            if not size:
+                return
+            if os.pread(fi.fileno(), 2, 0) == b"\x1f\x8b":
+                self._append_gzip(fi, size)
+            else:
+                with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    s, e = outfmt_span(mm, self.outfmt)
+                    if self.head:
+                        s, self.head = 0, False
+                    self._footer(mm[e:])
+                    if self.outfmt == "5":
+                        data, n = renumber_iterations(mm[s:e], self.iterations)
+                        self.iterations += n
+                        self.handler.write(data)
+                    elif isinstance(self.handler, io.FileIO):
+                        copy_range(fi, self.handler, s, e - s)
+                    else:
+                        for p in range(s, e, BLOCK_SIZE):
+                            self.handler.write(mm[p:min(p + BLOCK_SIZE, e)])
+        if self.on_append:
+            self.on_append(result)
+
+
+class ResultCache(object):
+
+    def __init__(self, path, max_size=0):
+        mkdir(path)
+        self.path = os.path.join(path, "hpc_blast_cache.sqlite")
+        self.max_size = max_size
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS hits (key BLOB PRIMARY KEY, hits BLOB, size INTEGER, atime REAL)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS hits_atime ON hits (atime)")
+
+    def get(self, keys, batch=500):
+        keys, found = list(keys), {}
+        with self.lock, self.db:
+            for i in range(0, len(keys), batch):
+                part = keys[i:i+batch]
+                marks = ",".join("?" * len(part))
+                found.update(self.db.execute(
+                    "SELECT key, hits FROM hits WHERE key IN (%s)" % marks, part))
+                self.db.execute("UPDATE hits SET atime = ? WHERE key IN (%s)" % marks,
+                                [time.time()] + part)
+        return found
+
+    def put(self, items):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+                                ((k, v, len(k) + len(v), now) for k, v in items))
+            if self.max_size > 0:
+                self._evict()
+
+    def _evict(self):
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+        if total <= self.max_size:
+            return
+        drop = []
+        for key, size in self.db.execute("SELECT key, size FROM hits ORDER BY atime"):
+            drop.append((key,))
+            total -= size
+            if total <= self.max_size:
+                break
+        self.db.executemany("DELETE FROM hits WHERE key = ?", drop)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class Manifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.header = {}
+        self.chunks = {}
+        self.results = {}
+        self.split_done = False
+        self.lock = Lock()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return self
+        with open(self.path) as fi:
+            for line in fi:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                kind = rec.pop("type")
+                if kind == "header":
+                    self.header = rec
+                elif kind == "chunk":
+                    self.chunks[rec["file"]] = rec
+                elif kind == "result":
+                    self.results[rec["file"]] = rec
+                elif kind == "split":
+                    self.split_done = True
+        return self
+
+    def save(self):
+        recs = [dict(self.header, type="header")]
+        recs.extend(dict(r, type="chunk") for r in self.chunks.values())
+        if self.split_done:
+            recs.append({"type": "split"})
+        recs.extend(dict(r, type="result") for r in self.results.values())
+        with self.lock:
+            with open(self.path + ".tmp", "w") as fo:
+                fo.writelines(json.dumps(r) + "\n" for r in recs)
+            os.replace(self.path + ".tmp", self.path)
+
+    def add(self, kind, path=None):
+        rec = {}
+        if path:
+            rec = {"file": os.path.relpath(path, os.path.dirname(self.path)), "size": os.path.getsize(path),
+                   "digest": file_digest(path)}
+        with self.lock:
+            with open(self.path, "a") as fo:
+                fo.write(json.dumps(dict(rec, type=kind)) + "\n")
+            if kind == "chunk":
+                self.chunks[rec["file"]] = rec
+            elif kind == "result":
+                self.results[rec["file"]] = rec
+            elif kind == "split":
+                self.split_done = True
+
+    def verify(self, kind, path):
+        rec = (kind == "chunk" and self.chunks or self.results).get(
+            os.path.relpath(path, os.path.dirname(self.path)))
+        return bool(rec) and os.path.isfile(path) and os.path.getsize(path) == rec["size"] \
+            and file_digest(path) == rec["digest"]
+
+
 class ArgumentsError(Exception):
     pass
 
 
+class ResourceModel(object):
+
+    def __init__(self, program, threads=1, floor=1, margin=1.25):
+        self.per_residue = blast_residue_bytes.get(program, 512)
+        self.dbtype = blast_dbtype.get(program, "nucl")
+        self.threads = max(threads, 1)
+        self.floor = max(floor or 1, 1)
+        self.margin = margin
+        self.db_bytes = {}
+        self.features = {}
+        self.ratios = {}
+        self.retries = {}
+        self.peak = 0
+        self.lock = Lock()
+
+    def add(self, result, fa, db):
+        if db not in self.db_bytes:
+            self.db_bytes[db] = blastdb_max_volume(db, self.dbtype)
+        self.features[result] = (fasta_file_residues(fa), db)
+
+    def predict(self, result):
+        residues, db = self.features[result]
+        return (256 << 20) + self.db_bytes[db] + residues * self.per_residue + self.threads * (64 << 20)
+
+    def memory(self, result):
+        if result not in self.features:
+            return self.floor
+        with self.lock:
+            ratios = self.ratios.get(self.features[result][1])
+            scale = (ratios and max(ratios) or 1.0) * self.margin
+            mem = self.predict(result) * scale * 2 ** self.retries.get(result, 0)
+        return max(self.floor, -(-int(mem) >> 30))
+
+    def __call__(self, cmd):
+        return self.memory(cmd_output(cmd)), self.threads
+
+    def learn(self, result, rss):
+        if result not in self.features:
+            return
+        with self.lock:
+            self.peak = max(self.peak, rss)
+            self.ratios.setdefault(self.features[result][1], deque(maxlen=32)).append(
+                rss / self.predict(result))
+
+    def failed(self, result):
+        with self.lock:
+            self.retries[result] = self.retries.get(result, 0) + 1
+
+
+class RunMetrics(object):
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.stages = OrderedDict()
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+
+    def start(self, stage):
+        self.stages[stage] = [time.time(), None]
+
+    def stop(self, stage):
+        if stage in self.stages:
+            self.stages[stage][1] = time.time()
+
+    def submit(self, result, fa, db, shard=None):
+        with self.lock:
+            self.jobs[result] = {"chunk": fa, "db": db,
+                                 "shard": shard, "submit": time.time()}
+
+    def report(self, query, root):
+        end = time.time()
+        with self.lock:
+            jobs = list(self.jobs.items())
+        chunks = OrderedDict()
+        for _, j in jobs:
+            if j["chunk"] not in chunks:
+                records, residues, size = fasta_file_stats(j["chunk"])
+                chunks[j["chunk"]] = {"chunk": os.path.relpath(j["chunk"], root), "records": records,
+                                      "residues": residues, "bytes": size}
+        stats = []
+        for result, j in jobs:
+            runs = read_stats(result + ".stats")
+            ok = [r for r in runs if r.get("exit") == 0]
+            last = ok and min(ok, key=lambda r: r["end"]) or runs and runs[-1] or {}
+            start, stop = last.get("start"), last.get("end")
+            stats.append({"result": os.path.relpath(result, root), "chunk": chunks[j["chunk"]]["chunk"],
+                          "db": j["db"], "shard": j["shard"], "host": last.get("host"), "exit": last.get("exit"),
+                          "attempts": len(runs), "rss": last.get("rss"), "submit": round(j["submit"], 3),
+                          "start": start, "end": stop,
+                          "queue_wait": None if start is None else round(max(start - j["submit"], 0), 3),
+                          "run": None if start is None else round(stop - start, 3)})
+        run = [s["run"] for s in stats if s["exit"] == 0]
+        wait = [s["queue_wait"] for s in stats if s["queue_wait"] is not None]
+        residues = sum(c["residues"] for c in chunks.values())
+        elapsed = end - self.t0
+        p50 = run and quantile(run, 0.5)
+        return {"query": query, "start": round(self.t0, 3), "end": round(end, 3), "elapsed": round(elapsed, 3),
+                "stages": {k: {"start": round(s, 3), "end": e and round(e, 3), "seconds": e and round(e - s, 3)}
+                           for k, (s, e) in self.stages.items()},
+                "chunks": len(chunks), "jobs": len(stats), "records": sum(c["records"] for c in chunks.values()),
+                "residues": residues, "bytes": sum(c["bytes"] for c in chunks.values()),
+                "failed_jobs": sum(s["exit"] != 0 for s in stats),
+                "failed_attempts": sum(s["attempts"] - (s["exit"] == 0) for s in stats),
+                "residues_per_second": round(residues / max(elapsed, 1e-6), 3),
+                "run_seconds": summary_stats(run), "queue_wait_seconds": summary_stats(wait),
+                "tail_ratio": p50 and round(max(run) / p50, 3) or None,
+                "peak_rss": max([s["rss"] or 0 for s in stats] or [0]),
+                "chunk_stats": list(chunks.values()), "job_stats": stats}
+
+
+def chunk_bucket(i, per_dir=1000):
+    return "%03d" % (i // per_dir)
+
+
 def mkdir(path):
     if not os.path.isdir(path):
         os.makedirs(path)
 
 
 def get_fastx_type(fastx):
+    if fastx == "-":
+        head = sys.stdin.buffer.peek(BLOCK_SIZE)
+        if head[:2] == b"\x1f\x8b":
+            head = zlib.decompressobj(31).decompress(head)
+        head = head.lstrip()
+        if not head:
+            sys.exit("No entries in stdin")
+        return head.startswith(b">") and "fasta" or "fastq"
     fastx_ = fastx.lower()
     if fastx_.endswith(".gz"):
         fastx_ = fastx_[:-3]
@@ -93,6 +1175,625 @@ def get_fastx_type(fastx):
     return fastx_type
 
 
+def fastq2fasta(lines):
+    del lines[3::4]
+    del lines[2::3]
+    offsets = list(map(add, list(accumulate(map(len, lines), initial=0))[::2],
+                       range(0, len(lines) + 2, 2)))
+    lines[0] = b">" + lines[0][1:]
+    lines.append(b"")
+    return b"\n".join(lines).replace(b"\n@", b"\n>"), offsets
+
+
+def fasta_offsets(buf):
+    offsets = [0, ]
+    i = buf.find(b"\n>")
+    while i >= 0:
+        offsets.append(i + 1)
+        i = buf.find(b"\n>", i + 1)
+    offsets.append(len(buf))
+    return offsets
+
+
+def fasta_residues(buf, offsets):
+    res = []
+    for s, e in zip(offsets, offsets[1:]):
+        h = buf.find(b"\n", s, e) + 1
+        res.append(e - h - buf.count(b"\n", h, e))
+    return res
+
+
+def outfmt_span(mm, outfmt="0"):
+    s, e = 0, len(mm)
+    if outfmt == "0":
+        s = mm.find(b"\nQuery= ") + 1
+        e = mm.rfind(b"\n  Database: ") + 1 or e
+    elif outfmt == "5":
+        i = mm.find(b"<BlastOutput_iterations>")
+        s = i >= 0 and mm.find(b"\n", i) + 1 or 0
+        i = mm.rfind(b"</BlastOutput_iterations>")
+        e = i >= s and i or e
+    elif outfmt == "7":
+        i = mm.rfind(b"# BLAST processed ")
+        e = i >= 0 and i or e
+    return s, e
+
+
+def renumber_iterations(data, offset=0):
+    n = len(re.findall(rb"<Iteration_iter-num>", data))
+    if offset:
+        data = re.sub(rb"(<Iteration_iter-num>|<Iteration_query-ID>Query_)(\d+)(?=<)",
+                      lambda m: m.group(1) + b"%d" % (int(m.group(2)) + offset), data)
+    return data, n
+
+
+def outfmt_columns(outfmt="6"):
+    cols = []
+    for c in outfmt.split()[1:] or ["std", ]:
+        cols.extend(c == "std" and STD_COLUMNS or [c, ])
+    return cols
+
+
+def _converter(t, missing):
+    def conv(v):
+        try:
+            return t(v)
+        except ValueError:
+            return missing
+    return conv
+
+
+def hit_types(columns):
+    return [c in INT_COLUMNS and int or c in FLOAT_COLUMNS and float or str for c in columns]
+
+
+def hit_record(columns):
+    class Hit(object):
+
+        __slots__ = tuple(columns)
+
+        def __init__(self, *values):
+            for k, v in zip(self.__slots__, values):
+                setattr(self, k, v)
+
+        def __iter__(self):
+            return (getattr(self, k) for k in self.__slots__)
+
+        def __repr__(self):
+            return "Hit(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__)
+    return Hit
+
+
+def tabular_rows(fi, columns, sep=b"\t", size=65536):
+    convs = [t is str and bytes.decode or _converter(t, t is int and -1 or float("nan"))
+             for t in hit_types(columns)]
+    rows = []
+    for line in fi:
+        if line.startswith(b"#") or not line.strip():
+            continue
+        f = line.rstrip(b"\n").split(sep)
+        f.extend([b""] * (len(convs) - len(f)))
+        rows.append(tuple(c(v) for c, v in zip(convs, f)))
+        if len(rows) >= size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def hits_array(rows, columns):
+    dtype = [(c, t is int and "i8" or t is float and "f8" or "U%d" % max(max(len(r[i]) for r in rows), 1))
+             for i, (c, t) in enumerate(zip(columns, hit_types(columns)))]
+    return np.array(rows, dtype=dtype)
+
+
+def fasta_ids(fa):
+    order, n = {}, 0
+    with open(fa, "rb") as fi:
+        for line in fi:
+            if line.startswith(b">"):
+                qid = line[1:].split(None, 1)[0]
+                order.setdefault(qid, n)
+                if qid.startswith(b"lcl|"):
+                    order.setdefault(qid[4:], n)
+                n += 1
+    for i in range(n):
+        order.setdefault(b"Query_%d" % (i + 1), i)
+    return order
+
+
+def tabular_groups(fi, qcol=0, sep=b"\t"):
+    lines = (line for line in fi if not line.startswith(b"#"))
+    for qid, group in groupby(lines, key=lambda x: x.split(sep, qcol + 1)[qcol].strip()):
+        yield qid, list(group)
+
+
+def batch_queries(spec):
+    if os.path.isfile(spec) and not re.search(r"\.(fa|fasta|fna|faa|fq|fastq)(\.gz)?$", spec, re.I):
+        with open(spec) as fi:
+            for line in fi:
+                f = line.split()
+                if f and not f[0].startswith("#"):
+                    yield os.path.abspath(f[0]), len(f) > 1 and os.path.abspath(f[1]) or None
+    else:
+        for q in sorted(glob.glob(spec)):
+            yield os.path.abspath(q), None
+
+
+def fastx_name(fastx):
+    return re.sub(r"(\.(fa|fasta|fna|faa|fq|fastq))?(\.gz)?$", "", os.path.basename(fastx), flags=re.I)
+
+
+def cmd_output(cmd):
+    cmd = shlex.split(cmd)
+    return "-out" in cmd and cmd[cmd.index("-out")+1] or None
+
+
+def file_digest(path, block_size=BLOCK_SIZE):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fi:
+        for b in iter(lambda: fi.read(block_size), b""):
+            h.update(b)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, samples=64, sample_size=1 << 16):
+    st = os.stat(path)
+    h = hashlib.blake2b(b"%d %d" % (st.st_size, st.st_mtime_ns),
+                        digest_size=16)
+    with open(path, "rb") as fi:
+        for i in range(samples):
+            fi.seek(max(st.st_size - sample_size, 0) * i // (samples - 1))
+            h.update(fi.read(sample_size))
+    return h.hexdigest()
+
+
+def dump_dups(path, dups):
+    with open(path, "wb") as fo:
+        for rep, ids in dups.items():
+            fo.writelines(rep + b"\t" + d + b"\n" for d in bytes(ids).split())
+
+
+def load_dups(path):
+    dups = {}
+    with open(path, "rb") as fi:
+        for line in fi:
+            rep, d = line.split()
+            dups.setdefault(rep, bytearray()).extend(d + b"\n")
+    return dups
+
+
+def mem_available():
+    try:
+        with open("/proc/meminfo") as fi:
+            for line in fi:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def parse_cpulist(s):
+    cpus = []
+    for part in s.strip().split(","):
+        if part:
+            a, _, b = part.partition("-")
+            cpus.extend(range(int(a), int(b or a) + 1))
+    return cpus
+
+
+def numa_nodes():
+    nodes = {}
+    for f in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+        with open(f) as fi:
+            nodes[int(re.search(r"node(\d+)", f).group(1))
+                  ] = parse_cpulist(fi.read())
+    return nodes
+
+
+def gzip_ratio(name, size=1 << 20):
+    with open(name, "rb") as fi:
+        data = fi.read(size)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = d.decompress(data, 64 << 20)
+    used = len(data) - len(d.unconsumed_tail) - len(d.unused_data)
+    return used and len(out) / used or 1.0
+
+
+def gzip_offsets(name):
+    size = os.path.getsize(name)
+    gzi = name + ".gzi"
+    if os.path.isfile(gzi) and os.path.getmtime(gzi) >= os.path.getmtime(name):
+        with open(gzi, "rb") as fi:
+            data = fi.read()
+        n = struct.unpack_from("<Q", data)[0]
+        return [0] + list(struct.unpack_from("<%dQ" % (2 * n), data, 8)[::2]) + [size]
+    offsets, index, pos, upos = [], [], 0, 0
+    with open(name, "rb") as fi:
+        while pos < size:
+            fi.seek(pos)
+            h = fi.read(18)
+            if len(h) < 18 or h[:4] != b"\x1f\x8b\x08\x04" or h[12:14] != b"BC":
+                return
+            offsets.append(pos)
+            index.extend((pos, upos))
+            pos += struct.unpack_from("<H", h, 16)[0] + 1
+            fi.seek(pos - 4)
+            upos += struct.unpack("<I", fi.read(4))[0]
+    write_gzi(gzi, index[2:])
+    return offsets + [size]
+
+
+def write_gzi(gzi, index):
+    tmp = "%s.%d.tmp" % (gzi, os.getpid())
+    try:
+        with open(tmp, "wb") as fo:
+            fo.write(struct.pack("<Q%dQ" % len(index), len(index) // 2, *index))
+        os.replace(tmp, gzi)
+    except OSError:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+
+def bgzf_compress(data, level=6):
+    blocks, data = [], memoryview(data)
+    for p in range(0, len(data), 0xff00):
+        b = data[p:p + 0xff00]
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        z = c.compress(b) + c.flush()
+        if len(z) > 65510:
+            c = zlib.compressobj(0, zlib.DEFLATED, -15)
+            z = c.compress(b) + c.flush()
+        blocks.append(struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(z) + 25))
+        blocks.append(z)
+        blocks.append(struct.pack("<2I", zlib.crc32(b), len(b)))
+    return b"".join(blocks)
+
+
+def is_gzip(path):
+    with open(path, "rb") as fi:
+        return fi.read(2) == b"\x1f\x8b"
+
+
+def open_result(path):
+    return is_gzip(path) and gzip.open(path, "rb") or open(path, "rb")
+
+
+def open_output(name, threads=None):
+    if isinstance(name, str) and name.endswith(".gz"):
+        return BgzfWriter(name, threads)
+    if isinstance(name, str) and name.endswith(".zst"):
+        threads = threads or min(len(os.sched_getaffinity(0)), 8)
+        if zstandard:
+            return zstandard.ZstdCompressor(threads=threads).stream_writer(open(name, "wb"))
+        if which("zstd"):
+            return CompressPipe(["zstd", "-q", "-c", "-T%d" % threads], name)
+        raise ArgumentsError(
+            "zstandard module or zstd command is required to write %s" % name)
+    return open(name, "wb", buffering=0)
+
+
+def inflate_range(name, start, end):
+    with open(name, "rb") as fi:
+        fi.seek(start)
+        data = fi.read(end - start)
+    mv, pos, out = memoryview(data), 0, []
+    while pos < len(data):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while not d.eof and pos < len(data):
+            out.append(d.decompress(mv[pos:pos + (1 << 18)]))
+            pos += min(1 << 18, len(data) - pos)
+        pos -= len(d.unused_data)
+    return b"".join(out)
+
+
+def fastx_sample(name, k=200, seed=0):
+    rng = random.Random(seed)
+    with FastxReader(name) as fi:
+        if fi.size:
+            starts = sorted({fi.next_record(rng.randrange(fi.size))
+                            for _ in range(k)} - {fi.size})
+            recs = [fi.mm[s:fi.next_record(s + 1)] for s in starts]
+            total = fi.size
+        else:
+            buf, offsets = next(iter(fi), (b"", [0]))
+            idx = rng.sample(range(len(offsets) - 1),
+                             min(k, len(offsets) - 1))
+            recs = [buf[offsets[i]:offsets[i+1]] for i in sorted(idx)]
+            total = os.path.getsize(name)
+            if name.endswith(".gz"):
+                total *= gzip_ratio(name)
+        buf = b"".join(recs)
+        offsets = [0] + list(accumulate(map(len, recs)))
+        residues = sum(fasta_residues(buf, offsets))
+        nbytes = len(buf) + (fi.fx == "fastq") * (residues + 3 * len(recs))
+    scale = nbytes and total / nbytes or 0
+    return buf, offsets, int(len(recs) * scale), int(residues * scale)
+
+
+def fasta_digests(buf, offsets, fold=True):
+    for s, e in zip(offsets, offsets[1:]):
+        h = buf.find(b"\n", s, e) + 1
+        seq = buf[h:e].replace(b"\n", b"")
+        yield buf[s+1:h].split(None, 1)[0], hashlib.blake2b(
+            fold and seq.upper() or seq, digest_size=16).digest()
+
+
+def fasta_subset(buf, offsets, keep):
+    if len(keep) == len(offsets) - 1:
+        return buf, offsets
+    recs = [buf[offsets[i]:offsets[i+1]] for i in keep]
+    return b"".join(recs), [0] + list(accumulate(map(len, recs)))
+
+
+def dedup_records(buf, offsets, index, dups, fold=True):
+    keep = []
+    for i, (qid, key) in enumerate(fasta_digests(buf, offsets, fold)):
+        rep = index.setdefault(key, qid)
+        if rep is qid:
+            keep.append(i)
+        else:
+            dups.setdefault(rep, bytearray()).extend(qid + b"\n")
+    return fasta_subset(buf, offsets, keep)
+
+
+def replace_column(lines, col, value, sep=b"\t"):
+    for line in lines:
+        f = line.rstrip(b"\n").split(sep)
+        f[col] = value
+        yield sep.join(f) + b"\n"
+
+
+def fanout_hits(infile, outfile, dups, qcol=0, sep=b"\t"):
+    with open(infile, "rb") as fi, open(outfile, "wb") as fo:
+        for qid, lines in tabular_groups(fi, qcol, sep):
+            fo.writelines(lines)
+            ids = dups.get(qid) or dups.get(b"lcl|" + qid)
+            for d in ids and bytes(ids).split() or []:
+                fo.writelines(replace_column(lines, qcol, d, sep))
+
+
+def top_hits(lines, cols, sep=b"\t", max_target_seqs=500, evalue=10.0):
+    s, e = cols.index("sseqid"), cols.index("evalue")
+    b = "bitscore" in cols and cols.index("bitscore") or None
+    subjects = {}
+    for line in lines:
+        f = line.rstrip(b"\n").split(sep)
+        ev = float(f[e])
+        if ev > evalue:
+            continue
+        bits = b is not None and -float(f[b]) or 0.0
+        hit = subjects.setdefault(f[s], [ev, bits, []])
+        hit[0], hit[1] = min(hit[0], ev), min(hit[1], bits)
+        hit[2].append(line)
+    best = heapq.nsmallest(max_target_seqs, subjects.values(),
+                           key=lambda x: (x[0], x[1]))
+    return b"".join(chain.from_iterable(h[2] for h in best))
+
+
+def merge_hits(results, outfile, order, cols, sep=b"\t", max_target_seqs=500, evalue=10.0):
+    q = cols.index("qseqid")
+    heap = []
+
+    def _index(qid, i):
+        idx = order.get(qid)
+        if idx is None:
+            idx = order.get(b"lcl|" + qid)
+        if idx is None and qid.startswith(b"lcl|"):
+            idx = order.get(qid[4:])
+        if idx is None:
+            raise ValueError("query id %s in %s not found in the chunk query" % (
+                qid.decode(errors="replace"), results[i]))
+        return idx
+
+    def _push(i, groups):
+        for qid, lines in groups:
+            heapq.heappush(heap, (_index(qid, i), i, lines, groups))
+            break
+    with MultiFileOpen(*results, mode="rb") as fi, open(outfile, "wb") as fo:
+        for i in range(len(results)):
+            _push(i, tabular_groups(fi[i], q, sep))
+        while heap:
+            idx, i, lines, groups = heapq.heappop(heap)
+            _push(i, groups)
+            while heap and heap[0][0] == idx:
+                _, j, more, others = heapq.heappop(heap)
+                lines.extend(more)
+                _push(j, others)
+            fo.write(top_hits(lines, cols, sep, max_target_seqs, evalue))
+
+
+def blastdb_volumes(db, dbtype="nucl"):
+    blastdb_path = which("blastdb_path")
+    if not blastdb_path:
+        raise ArgumentsError("blastdb_path not found in this environment")
+    out = subprocess.check_output(
+        [blastdb_path, "-db", db, "-dbtype", dbtype, "-getvolumespath"]).decode()
+    vols = [re.sub(r"\.[np][a-z]{2}$", "", v) for v in out.split()]
+    return sorted(set(vols), key=vols.index)
+
+
+def blastdb_info(db, dbtype="nucl"):
+    blastdbcmd = which("blastdbcmd")
+    if not blastdbcmd:
+        raise ArgumentsError("blastdbcmd not found in this environment")
+    out = subprocess.check_output(
+        [blastdbcmd, "-db", db, "-dbtype", dbtype, "-info"]).decode()
+    seqs, letters = re.search(
+        r"([\d,]+) sequences;\s+([\d,]+) total", out).group(1, 2)
+    return int(seqs.replace(",", "")), int(letters.replace(",", ""))
+
+
+def blastdb_max_volume(db, dbtype="nucl"):
+    sizes = [0]
+    for d in db.split():
+        try:
+            vols = blastdb_volumes(d, dbtype)
+        except (ArgumentsError, subprocess.CalledProcessError):
+            vols = [d, ]
+        sizes.extend(sum(os.path.getsize(f) for f in glob.glob(v + ".*") if os.path.isfile(f))
+                     for v in vols)
+    return max(sizes)
+
+
+def fasta_file_residues(fa):
+    with FastxReader(fa, "fasta") as fi:
+        return sum(sum(fasta_residues(buf, offsets)) for buf, offsets in fi)
+
+
+def fasta_file_stats(fa):
+    records = residues = 0
+    with FastxReader(fa, "fasta") as fi:
+        for buf, offsets in fi:
+            records += len(offsets) - 1
+            residues += sum(fasta_residues(buf, offsets))
+    return records, residues, os.path.getsize(fa)
+
+
+def read_stats(path):
+    stats = []
+    try:
+        with open(path) as fi:
+            for line in fi:
+                try:
+                    stats.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return stats
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def summary_stats(values):
+    if not values:
+        return {}
+    return {"min": min(values), "p50": quantile(values, 0.5), "p90": quantile(values, 0.9),
+            "max": max(values), "mean": round(sum(values) / len(values), 3)}
+
+
+def metrics_summary(report):
+    run, wait = report["run_seconds"], report["queue_wait_seconds"]
+    return "metrics: %d chunk jobs, %d records, %d residues in %.1fs (%.4g residues/s), chunk run p50 %.1fs max %.1fs, " \
+        "tail ratio (max/p50) %s, queue wait p50 %.1fs max %.1fs, peak rss %.2fG, %d failed attempts" % (
+            report["jobs"], report["records"], report["residues"], report["elapsed"], report["residues_per_second"],
+            run.get("p50", 0), run.get("max", 0), report["tail_ratio"] and "%.2f" % report["tail_ratio"] or "-",
+            wait.get("p50", 0), wait.get("max", 0), report["peak_rss"] / 2**30, report["failed_attempts"])
+
+
+def dump_metrics(path, report):
+    mkdir(os.path.dirname(os.path.abspath(path)))
+    with open(path + ".tmp", "w") as fo:
+        json.dump(report, fo, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def prom_label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def dump_prom(path, reports):
+    metrics = [
+        ("elapsed_seconds", "wall time of the hpc-blast run", lambda r: [({}, r["elapsed"])]),
+        ("stage_seconds", "wall time of each hpc-blast stage", lambda r: [
+            ({"stage": k}, v["seconds"]) for k, v in r["stages"].items() if v["seconds"] is not None]),
+        ("chunk_jobs", "number of chunk jobs run", lambda r: [({}, r["jobs"])]),
+        ("records", "query records searched", lambda r: [({}, r["records"])]),
+        ("residues", "query residues searched", lambda r: [({}, r["residues"])]),
+        ("residues_per_second", "query residues searched per second of wall time",
+         lambda r: [({}, r["residues_per_second"])]),
+        ("chunk_run_seconds", "run time quantiles of chunk jobs", lambda r: [
+            ({"quantile": q}, r["run_seconds"][k]) for q, k in [("0.5", "p50"), ("0.9", "p90"), ("1", "max")]
+            if k in r["run_seconds"]]),
+        ("chunk_queue_wait_seconds", "queue wait quantiles of chunk jobs", lambda r: [
+            ({"quantile": q}, r["queue_wait_seconds"][k]) for q, k in [("0.5", "p50"), ("0.9", "p90"), ("1", "max")]
+            if k in r["queue_wait_seconds"]]),
+        ("tail_latency_ratio", "max over median run time of chunk jobs", lambda r: [
+            ({}, r["tail_ratio"])] if r["tail_ratio"] else []),
+        ("peak_rss_bytes", "peak resident memory of chunk jobs", lambda r: [({}, r["peak_rss"])]),
+        ("failed_attempts", "failed chunk job attempts", lambda r: [({}, r["failed_attempts"])]),
+        ("end_timestamp_seconds", "end time of the hpc-blast run", lambda r: [({}, r["end"])]),
+    ]
+    lines = []
+    for name, doc, values in metrics:
+        lines.append("# HELP hpc_blast_%s %s" % (name, doc))
+        lines.append("# TYPE hpc_blast_%s gauge" % name)
+        for r in reports:
+            for labels, v in values(r):
+                labels = dict(query=r["query"], **labels)
+                lines.append("hpc_blast_%s{%s} %s" % (name, ",".join('%s="%s"' % (k, prom_label(v))
+                                                                       for k, v in labels.items()), v))
+    mkdir(os.path.dirname(os.path.abspath(path)))
+    with open(path + ".tmp", "w") as fo:
+        fo.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def blastdb_fingerprint(db, dbtype="nucl"):
+    h = hashlib.blake2b(digest_size=16)
+    for f in blastdb_files(db, dbtype):
+        st = os.stat(f)
+        h.update(b"%s %d %d\n" % (os.path.basename(f).encode(),
+                                   st.st_size, st.st_mtime_ns))
+    return h.hexdigest()
+
+
+def blast_options_key(options, ignore=("-out", "-query", "-db", "-num_threads", "-mt_mode")):
+    opts = []
+    for o in options:
+        if re.match(r"-[A-Za-z]", o):
+            opts.append([o])
+        elif opts:
+            opts[-1].append(" ".join(o.strip("'").strip('"').split()))
+    return sorted(o for o in opts if o[0] not in ignore)
+
+
+def blastdb_files(db, dbtype="nucl"):
+    files = []
+    for d in db.split():
+        try:
+            vols = blastdb_volumes(d, dbtype)
+        except (ArgumentsError, subprocess.CalledProcessError):
+            vols = [d, ]
+        for v in vols:
+            files.extend(f for f in sorted(glob.glob(v + ".*"))
+                         if os.path.isfile(f) and f not in files)
+    return files
+
+
+def copy_range(src, dst, offset, count):
+    dst.flush()
+    copy_file_range = getattr(os, "copy_file_range", None)
+    while count > 0:
+        try:
+            if copy_file_range:
+                n = copy_file_range(
+                    src.fileno(), dst.fileno(), count, offset)
+            else:
+                n = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+        except OSError:
+            if not copy_file_range:
+                raise
+            copy_file_range = None
+            continue
+        if n == 0:
+            break
+        offset += n
+        count -= n
+
+
+def detach_stdout():
+    sys.stdout.flush()
+    fd = os.dup(1)
+    os.dup2(2, 1)
+    return fd
+
+
 def which(program, paths=None):
     ex = os.path.dirname(sys.executable)
     found_path = None
@@ -140,6 +1841,18 @@ def human_size_parse(size):
         return int(s)
 
 
+def human_time_parse(t):
+    units = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+    return sum(float(n) * units[u.lower()] for n, u in re.findall(r"(\d+(?:\.\d+)?)([smhdSMHD]?)", str(t)))
+
+
+def wall_time(t):
+    if not re.fullmatch(r"(\d+(\.\d+)?[smhdSMHD]?)+", t) or not human_time_parse(t):
+        raise argparse.ArgumentTypeError(
+            "invalid time '%s', use e.g. 90s, 30m, 2h or 1h30m" % t)
+    return t
+
+
 def callcmd(cmd, run=True, verbose=False):
     if not cmd:
         return
@@ -160,6 +1873,15 @@ def canonicalize(path):
     return os.path.abspath(os.path.expanduser(path))
 
 
+STD_COLUMNS = ["qseqid", "sseqid", "pident", "length", "mismatch", "gapopen",
+               "qstart", "qend", "sstart", "send", "evalue", "bitscore"]
+
+INT_COLUMNS = {"qlen", "slen", "qstart", "qend", "sstart", "send", "length", "mismatch", "gapopen",
+               "gaps", "nident", "positive", "score", "qframe", "sframe", "staxid"}
+
+FLOAT_COLUMNS = {"evalue", "bitscore", "pident",
+                 "ppos", "qcovs", "qcovhsp", "qcovus"}
+
 blast_dbtype = {
     "blastn": "nucl",
     "blastp": "prot",
@@ -169,6 +1891,15 @@ blast_dbtype = {
 }
 
 
+blast_residue_bytes = {
+    "blastn": 64,
+    "blastp": 512,
+    "blastx": 3072,
+    "tblastn": 512,
+    "tblastx": 3072,
+}
+
+
 def rate_parser(parser):
     rate_args = parser.add_argument_group("rate arguments")
     rate_args.add_argument('--retry', help="retry N times of the error job, 0 or minus means do not re-submit.",
@@ -199,12 +1930,62 @@ def resource_parser(parser):
 def control_parser(parser):
     control_args_parser = parser.add_argument_group("control arguments")
     ex_args = control_args_parser.add_mutually_exclusive_group(required=False)
-    ex_args.add_argument("--split", type=int, default=10,
-                         help='split query into num of chunks, 10 by default', metavar="<int>")
+    ex_args.add_argument("--split", type=int,
+                         help='split query into num of chunks, 10 by default, 8 per worker with --dynamic', metavar="<int>")
     ex_args.add_argument("--size", type=int,
                          help='split query into multi chunks with N sequences', metavar="<int>")
+    ex_args.add_argument("--auto", type=wall_time,
+                         help="plan chunk number and -num_threads (up to --cpu) from a calibration blast of a query sample to finish in the given wall time (e.g. 30m, 2h) with predicted peak memory of each chunk job within --memory", metavar="<time>")
     ex_args.add_argument("--filesize", type=str,
                          help="split query into multi chunks with define filesize, 1G, 500M", metavar="<str/float>")
+    control_args_parser.add_argument("--balance", type=str, default="records", choices=["records", "residues"],
+                                     help='balance --split chunks by number of records or total residues, "records" by default', metavar="<str>")
+    control_args_parser.add_argument("--pipeline", action="store_true", default=False,
+                                     help='submit each chunk as soon as it is split, overlapping query splitting with blast jobs')
+    control_args_parser.add_argument("--db-shards", type=int,
+                                     help='also split each -db into N shards of its volumes (0 for one shard per volume), run query chunks x db shards jobs and merge hits with global -max_target_seqs/-evalue, tabular -outfmt 6/10 only', metavar="<int>")
+    control_args_parser.add_argument("--merge-dbs", action="store_true", default=False,
+                                     help='merge hits of multiple -db per query with one effective database size and global -max_target_seqs/-evalue, tabular -outfmt 6/10 only')
+    control_args_parser.add_argument("--dedup", action="store_true", default=False,
+                                     help="blast identical query sequences (case-insensitive unless -lcase_masking) only once and copy their hits to every duplicate, only tabular -outfmt 6/10 with qseqid supported")
+    control_args_parser.add_argument("--cache", type=str,
+                                     help="persistent result cache directory, cached query sequences are not blasted again with the same database and options, only tabular -outfmt 6/10 with qseqid supported", metavar="<dir>")
+    control_args_parser.add_argument("--cache-size", type=str, default="10G",
+                                     help="max size of result cache, least recently used hits evicted, 10G by default", metavar="<str>")
+    control_args_parser.add_argument("--extra-outfmt", type=str, nargs=2, action="append",
+                                     help="also write the results in another -outfmt to a file, chunk jobs search once into -outfmt 11 archives formatted by blast_formatter into every format in parallel, can be used multiple times", metavar=("<outfmt>", "<file>"))
+    control_args_parser.add_argument("--compress-results", action="store_true", default=False,
+                                     help="pipe blast output of each chunk job through a bgzf compressor so chunk results are stored compressed, tabular -outfmt 6/7/10 only")
+    control_args_parser.add_argument("--warmup", action="store_true", default=False,
+                                     help='warm up blast database page cache once per execution node before its chunk jobs')
+    control_args_parser.add_argument("--warmup-mem", type=str, default="5G",
+                                     help='max size of database files cached per node, 5G by default', metavar="<str>")
+    control_args_parser.add_argument("--scratch", type=str,
+                                     help="node-local directory where each chunk job stages its query chunk and writes its result before moving it back, environment variables like '$TMPDIR' are expanded on the node", metavar="<dir>")
+    control_args_parser.add_argument("--scratch-db", action="store_true", default=False,
+                                     help="also copy database volumes to --scratch once per node and reuse them while unchanged")
+    control_args_parser.add_argument("--auto-resources", action="store_true", default=False,
+                                     help="request memory of each chunk job from its residues, database volume sizes and blast program, corrected by the peak memory of finished chunks, --memory and --cpu become minimums")
+    control_args_parser.add_argument("--dynamic", type=int,
+                                     help="run N long-lived workers pulling query chunks from a work queue, 8 chunks per worker unless --split/--size/--filesize given", metavar="<int>")
+    control_args_parser.add_argument("--straggler", type=float, default=3.0,
+                                     help="with --dynamic, launch a speculative copy of a chunk running longer than N times the median, first copy to finish wins, 3.0 by default", metavar="<float>")
+    control_args_parser.add_argument("--array", action="store_true", default=False,
+                                     help="submit all chunk jobs as one sge/slurm array job and poll status once per array")
+    control_args_parser.add_argument("--batch", type=str,
+                                     help="run many query files in one job session, a glob or a file listing 'query [output]' per line, -out is the output directory of queries without output", metavar="<glob/file>")
+    control_args_parser.add_argument("--pool", action="store_true", default=False,
+                                     help="with --local, run chunk jobs in a built-in worker pool that packs -num_threads cores and --memory per job and pins jobs to their cores")
+    control_args_parser.add_argument("--pool-cores", type=int,
+                                     help="total cores of --pool, all cores of this process by default", metavar="<int>")
+    control_args_parser.add_argument("--pool-mem", type=str,
+                                     help="total memory of --pool, available memory by default", metavar="<str>")
+    control_args_parser.add_argument("--numa", action="store_true", default=False,
+                                     help="keep the cores of each --pool job on one NUMA node")
+    control_args_parser.add_argument("--metrics", type=str,
+                                     help="write per-stage and per-chunk run metrics as json to file, metrics.json in --tempdir by default", metavar="<file>")
+    control_args_parser.add_argument("--metrics-prom", type=str,
+                                     help="also write run metrics to a prometheus textfile", metavar="<file>")
     control_args_parser.add_argument("--num", type=int,
                                      help='max number of chunks run parallelly, all chunks by default', metavar="<int>")
 
@@ -231,7 +2012,7 @@ def hpcblast_rate_resource_args(args):
     return " ".join(map(str, out))
 
 
-def HPCBlastArg():
+def HPCBlastArg(argv=None):
     parser = argparse.ArgumentParser(
         description="hpc-blast <OPTIONS> <blast command>",
         formatter_class=CustomHelpFormatter,
@@ -240,7 +2021,7 @@ def HPCBlastArg():
     parser.add_argument("--tempdir", type=str, required=False,
                         help='hpc blast temp directory', metavar="<dir>")
     parser.add_argument("--log", type=str,
-                        help='append hpc-blast log info to file, sys.stdout by default', metavar="<file>")
+                        help='append hpc-blast log info to file, sys.stdout by default, sys.stderr with -out -', metavar="<file>")
     parser.add_argument("--local", action='store_true',
                         help="run blast in localhost instead of sge", default=False)
     parser.add_argument("--slurm", action='store_true',
@@ -255,11 +2036,12 @@ def HPCBlastArg():
                         help='blast command, required', metavar="<blast command>")
     resource_parser(parser)
     rate_parser(parser)
-    args, unknown_args = parser.parse_known_args()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args, unknown_args = parser.parse_known_args(argv)
     args.blast_db = []
     c, o, d, q = 0, 0, 0, 0
     db_end = False
-    for a in sys.argv[1:]:
+    for a in argv:
         if d and a.startswith("-"):
             db_end = True
             d = 0
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import json
+import time
+import fcntl
+import socket
+
+from .utils import *
+
+
+def touch_files(files, budget=0):
+    total, todo = 0, []
+    for f in files:
+        size = os.path.getsize(f)
+        if budget and total + size > budget:
+            continue
+        total += size
+        todo.append(f)
+    vmtouch = which("vmtouch")
+    if vmtouch:
+        with open(os.devnull, "w") as fo:
+            subprocess.check_call([vmtouch, "-tq"] + todo, stdout=fo)
+        return total, len(todo), "vmtouch"
+    buf = bytearray(BLOCK_SIZE)
+    for f in todo:
+        with open(f, "rb", buffering=0) as fi:
+            os.posix_fadvise(fi.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while fi.readinto(buf):
+                pass
+    return total, len(todo), "readahead"
+
+
+def warmup_db(filelist, budget=0):
+    host = socket.gethostname()
+    name = os.path.splitext(os.path.basename(filelist))[0]
+    prefix = os.path.join(os.path.dirname(filelist), "%s.%s" % (name, host))
+    with open(filelist) as fi:
+        files = [f.strip() for f in fi if f.strip()]
+    avail = mem_available()
+    if avail:
+        budget = budget and min(budget, avail) or avail
+    with open(prefix + ".lock", "w") as lk:
+        fcntl.flock(lk, fcntl.LOCK_EX)
+        if os.path.isfile(prefix + ".json"):
+            return
+        t = time.time()
+        size, num, method = touch_files(files, budget)
+        with open(prefix + ".json", "w") as fo:
+            json.dump({"db": name, "host": host, "files": num, "bytes": size,
+                       "seconds": round(time.time() - t, 3), "method": method}, fo)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="warm up blast database page cache once per node")
+    parser.add_argument("--budget", type=str, default="0",
+                        help="max bytes of database files to cache, all available memory by default", metavar="<str>")
+    parser.add_argument("filelist", type=str,
+                        help="file with one database file per line", metavar="<file>")
+    args = parser.parse_args()
+    warmup_db(args.filelist, human_size_parse(args.budget))
+
+
+if __name__ == "__main__":
+    main()
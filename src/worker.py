@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import json
+import time
+import socket
+
+from .utils import *
+
+
+def claim_task(queue):
+    todo = os.path.join(queue, "todo")
+    for ticket in sorted(os.listdir(todo)):
+        try:
+            os.rename(os.path.join(todo, ticket),
+                      os.path.join(queue, "claimed", ticket))
+        except OSError:
+            continue
+        return ticket
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    proc.wait()
+
+
+def run_task(queue, ticket, worker, poll=1.0):
+    name, spec = ticket.rsplit(".", 1)
+    tid = name.split("-", 1)[1]
+    won = os.path.join(queue, "won", tid)
+    if os.path.exists(won):
+        return
+    with open(os.path.join(queue, "tasks", tid + ".json")) as fi:
+        cmds = json.load(fi)["cmds"]
+    t, outs = time.time(), []
+    try:
+        for cmd in cmds:
+            out = cmd_output(cmd)
+            tmp = "%s.copy%s" % (out, spec)
+            outs.append((tmp, out))
+            proc = subprocess.Popen(cmd.replace(" -out %s " % shlex.quote(out), " -out %s " % shlex.quote(tmp)),
+                                    shell=True, start_new_session=True)
+            while True:
+                try:
+                    rc = proc.wait(poll)
+                    break
+                except subprocess.TimeoutExpired:
+                    if os.path.exists(won):
+                        _kill(proc)
+                        return
+            if rc:
+                with open(os.path.join(queue, "failed", ticket + ".json"), "w") as fo:
+                    json.dump({"worker": worker, "exit": rc, "cmd": cmd}, fo)
+                return
+        try:
+            os.close(os.open(won, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return
+        for tmp, out in outs:
+            os.replace(tmp, out)
+        outs = []
+        done = os.path.join(queue, "done", tid + ".json")
+        with open(done + ".tmp", "w") as fo:
+            json.dump({"worker": worker, "copy": int(spec),
+                       "seconds": round(time.time() - t, 3)}, fo)
+        os.replace(done + ".tmp", done)
+    finally:
+        for tmp, out in outs:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="pull hpc-blast chunk tasks from a queue directory until it is stopped")
+    parser.add_argument("--poll", type=float, default=1.0,
+                        help="seconds between queue polls, 1 by default", metavar="<float>")
+    parser.add_argument("queue", type=str,
+                        help="queue directory", metavar="<dir>")
+    args = parser.parse_args()
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    while True:
+        ticket = claim_task(args.queue)
+        if ticket:
+            run_task(args.queue, ticket, worker, args.poll)
+        elif os.path.exists(os.path.join(args.queue, "stop")):
+            break
+        else:
+            time.sleep(args.poll)
+
+
+if __name__ == "__main__":
+    main()
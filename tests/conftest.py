@@ -0,0 +1,13 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def blastn(tmp_path, monkeypatch):
+    exe = tmp_path / "bin" / "blastn"
+    exe.parent.mkdir()
+    exe.write_text("#!/bin/sh\n")
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", str(exe.parent) + os.pathsep + os.environ["PATH"])
+    return str(exe)
@@ -0,0 +1,46 @@
+import os
+import gzip
+
+from src.utils import BgzfReader, BgzfWriter, Zopen, gzip_offsets
+
+
+def write_bgzf(path, n=20000):
+    data = b"".join(b">r%d\n%s\n" % (i, b"ACGT" * 30) for i in range(n))
+    with BgzfWriter(str(path), threads=2, block_size=1 << 16) as fo:
+        fo.write(data)
+    return str(path), data
+
+
+def test_bgzf_reader_reads_all_blocks(tmp_path):
+    name, data = write_bgzf(tmp_path / "q.fa.gz")
+    with Zopen(name) as fi:
+        assert fi.read() == data
+
+
+def test_bgzf_reader_close_cancels_pending_blocks(tmp_path):
+    name, data = write_bgzf(tmp_path / "q.fa.gz")
+    r = BgzfReader(name, gzip_offsets(name), threads=2, block_size=1 << 12)
+    assert r.read(10) == data[:10]
+    r.close()
+    assert r.closed and all(f.done() for f in r.pending)
+
+
+def test_gzip_offsets_writes_and_reuses_gzi(tmp_path):
+    name, data = write_bgzf(tmp_path / "q.fa.gz")
+    offsets = gzip_offsets(name)
+    gzi = tmp_path / "q.fa.gz.gzi"
+    assert gzi.is_file()
+    assert gzip_offsets(name) == offsets
+    with open(name, "r+b") as fo:
+        fo.write(b"\0\0")
+    os.utime(name, (1, 1))
+    assert gzip_offsets(name) == offsets
+    os.utime(str(gzi), (0, 0))
+    assert gzip_offsets(name) is None
+
+
+def test_gzip_offsets_skips_plain_gzip(tmp_path):
+    name = tmp_path / "q.fa.gz"
+    name.write_bytes(gzip.compress(b">a\nACGT\n") + gzip.compress(b">b\nACGT\n"))
+    assert gzip_offsets(str(name)) is None
+    assert not (tmp_path / "q.fa.gz.gzi").exists()
@@ -0,0 +1,18 @@
+from src.utils import dedup_records
+
+FA = b">q1\nACGTacgt\n>q2\nACGTACGT\n>q3\nACGTacgt\n"
+OFFSETS = [0, 13, 26, 39]
+
+
+def test_dedup_folds_case_by_default():
+    dups = {}
+    buf, offsets = dedup_records(FA, OFFSETS, {}, dups)
+    assert buf == b">q1\nACGTacgt\n"
+    assert bytes(dups[b"q1"]).split() == [b"q2", b"q3"]
+
+
+def test_dedup_keeps_soft_masked_records_apart():
+    dups = {}
+    buf, offsets = dedup_records(FA, OFFSETS, {}, dups, fold=False)
+    assert buf == b">q1\nACGTacgt\n>q2\nACGTACGT\n"
+    assert bytes(dups[b"q1"]).split() == [b"q3"]
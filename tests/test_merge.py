@@ -0,0 +1,78 @@
+import pytest
+
+from src.src import HPCBlast, HPCBlastArg
+from src.utils import merge_hits, fasta_ids
+
+COLS = ["qseqid", "sseqid", "evalue", "bitscore"]
+
+
+def write(path, text):
+    path.write_bytes(text)
+    return str(path)
+
+
+def test_merge_hits_normalizes_lcl_ids(tmp_path):
+    fa = write(tmp_path / "q.fa", b">lcl|q1\nACGT\n>q2\nACGT\n")
+    a = write(tmp_path / "a.m6", b"q1\ts1\t1e-5\t50\nq2\ts1\t1e-5\t50\n")
+    b = write(tmp_path / "b.m6", b"lcl|q1\ts2\t1e-9\t80\nlcl|q2\ts2\t1e-3\t20\n")
+    out = tmp_path / "out.m6"
+    merge_hits([a, b], str(out), fasta_ids(fa), COLS, max_target_seqs=1)
+    assert out.read_bytes() == b"lcl|q1\ts2\t1e-9\t80\nq2\ts1\t1e-5\t50\n"
+
+
+def test_merge_hits_fails_on_unknown_id(tmp_path):
+    fa = write(tmp_path / "q.fa", b">q1\nACGT\n>q2\nACGT\n")
+    a = write(tmp_path / "a.m6", b"q1\ts1\t1e-5\t50\nq3\ts1\t1e-5\t50\n")
+    b = write(tmp_path / "b.m6", b"q2\ts2\t1e-9\t80\n")
+    with pytest.raises(ValueError, match="q3"):
+        merge_hits([a, b], str(tmp_path / "out.m6"), fasta_ids(fa), COLS)
+
+
+def test_merge_hits_keeps_global_top_targets_across_databases(tmp_path):
+    fa = write(tmp_path / "q.fa", b">q1\nACGT\n>q2\nACGT\n")
+    a = write(tmp_path / "a.m6", b"q1\tdb0_s1\t1e-10\t70\nq1\tdb0_s1\t1e-4\t30\nq1\tdb0_s2\t1e-3\t25\n"
+                                 b"q2\tdb0_s5\t1e-30\t99\n")
+    b = write(tmp_path / "b.m6", b"q1\tdb1_s3\t1e-8\t60\nq1\tdb1_s4\t1e-20\t90\n"
+                                 b"q2\tdb1_s6\t1e-30\t120\nq2\tdb1_s7\t1.0\t10\n")
+    out = tmp_path / "out.m6"
+    merge_hits([a, b], str(out), fasta_ids(fa), COLS, max_target_seqs=2)
+    assert out.read_bytes() == (b"q1\tdb1_s4\t1e-20\t90\nq1\tdb0_s1\t1e-10\t70\nq1\tdb0_s1\t1e-4\t30\n"
+                                b"q2\tdb1_s6\t1e-30\t120\nq2\tdb0_s5\t1e-30\t99\n")
+
+
+def test_merge_hits_filters_evalue_across_databases(tmp_path):
+    fa = write(tmp_path / "q.fa", b">q1\nACGT\n>q2\nACGT\n")
+    a = write(tmp_path / "a.m6", b"q1\tdb0_s1\t1e-10\t70\nq1\tdb0_s2\t1e-3\t25\nq2\tdb0_s5\t0.5\t20\n")
+    b = write(tmp_path / "b.m6", b"q1\tdb1_s3\t1e-6\t60\nq2\tdb1_s6\t0.01\t30\n")
+    out = tmp_path / "out.m6"
+    merge_hits([a, b], str(out), fasta_ids(fa), COLS, evalue=1e-5)
+    assert out.read_bytes() == b"q1\tdb0_s1\t1e-10\t70\nq1\tdb1_s3\t1e-6\t60\n"
+
+
+@pytest.fixture
+def blastdbcmd(tmp_path, blastn):
+    exe = tmp_path / "bin" / "blastdbcmd"
+    exe.write_text('#!/bin/sh\ncase "$2" in *db0) n=1,000;; *) n=2,500;; esac\n'
+                   'printf "Database: test\\n\\t10 sequences; %s total letters\\n" $n\n')
+    exe.chmod(0o755)
+    return str(exe)
+
+
+def merge_dbs(tmp_path, *opts):
+    query = write(tmp_path / "q.fa", b">q1\nACGT\n")
+    args, blast_options = HPCBlastArg(["--local", "--tempdir", str(tmp_path / "tmp"), "--merge-dbs", "blastn",
+                                       "-query", query, "-db", str(tmp_path / "db0"), str(tmp_path / "db1"),
+                                       "-outfmt", "6", "-out", str(tmp_path / "out.m6")] + list(opts))
+    h = HPCBlast(args, blast_options)
+    h._shard_db()
+    return [h._blast_cmd(write(tmp_path / "q.00000.fa", b">q1\nACGT\n"), n) for n in range(2)]
+
+
+def test_merge_dbs_sets_dbsize_to_summed_letters(tmp_path, blastdbcmd):
+    for cmd in merge_dbs(tmp_path):
+        assert "-dbsize 3500 " in cmd
+
+
+def test_merge_dbs_keeps_user_dbsize(tmp_path, blastdbcmd):
+    for cmd in merge_dbs(tmp_path, "-dbsize", "100"):
+        assert cmd.count("-dbsize") == 1 and "-dbsize 100 " in cmd
@@ -0,0 +1,63 @@
+import gzip
+
+from src.utils import ResultMerger
+
+
+def merge(tmp_path, outfmt, chunks, out="out"):
+    results = []
+    for i, text in enumerate(chunks):
+        results.append(str(tmp_path / ("result.%d" % i)))
+        with open(results[-1], "wb") as fo:
+            fo.write(text)
+    m = ResultMerger(str(tmp_path / out), results, outfmt)
+    m.finish(*reversed(results))
+    m.close()
+    return tmp_path / out
+
+
+def pairwise(queries):
+    return (b"BLASTN 2.12.0+\n\n\nDatabase: db\n           3 sequences; 300 total letters\n\n\n\n" +
+            b"".join(b"Query= %s\n\nLength=8\n***** No hits found *****\n\n\n\n" % q for q in queries) +
+            b"Lambda      K        H\n  Database: db\n    Posted date:  Jan 1, 2026\n"
+            b"  Number of letters in database: 300\n\nMatrix: blastn matrix 1 -2\n")
+
+
+def test_merge_pairwise_keeps_one_header_and_footer(tmp_path):
+    out = merge(tmp_path, "0", [pairwise([b"q1", b"q2"]), pairwise([b"q3"])]).read_bytes()
+    assert out.count(b"BLASTN 2.12.0+") == 1
+    assert out.count(b"  Database: db\n") == 1
+    assert [l for l in out.splitlines() if l.startswith(b"Query= ")] == [b"Query= q1", b"Query= q2", b"Query= q3"]
+    assert out.endswith(b"Matrix: blastn matrix 1 -2\n")
+
+
+def commented(queries):
+    return b"".join(b"# BLASTN 2.12.0+\n# Query: %s\n# Database: db\n# 1 hits found\n%s\ts1\t100.0\n" % (q, q)
+                    for q in queries) + b"# BLAST processed %d queries\n" % len(queries)
+
+
+def test_merge_commented_tabular_sums_processed_queries(tmp_path):
+    out = merge(tmp_path, "7", [commented([b"q1", b"q2"]), commented([b"q3"]), commented([b"q4", b"q5"])])
+    data = out.read_bytes()
+    assert data == commented([b"q1", b"q2", b"q3", b"q4", b"q5"])
+    assert data.count(b"# BLAST processed") == 1
+
+
+def xml(queries):
+    return (b'<?xml version="1.0"?>\n<BlastOutput>\n  <BlastOutput_program>blastn</BlastOutput_program>\n'
+            b"  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n  <BlastOutput_iterations>\n" +
+            b"".join(b"<Iteration>\n  <Iteration_iter-num>%d</Iteration_iter-num>\n"
+                     b"  <Iteration_query-ID>Query_%d</Iteration_query-ID>\n"
+                     b"  <Iteration_query-def>%s</Iteration_query-def>\n</Iteration>\n" % (i + 1, i + 1, q)
+                     for i, q in enumerate(queries)) +
+            b"</BlastOutput_iterations>\n</BlastOutput>\n")
+
+
+def test_merge_xml_renumbers_iterations(tmp_path):
+    out = merge(tmp_path, "5", [xml([b"q1", b"q2"]), xml([b"q3"]), xml([b"q4"])])
+    assert out.read_bytes() == xml([b"q1", b"q2", b"q3", b"q4"])
+
+
+def test_merge_tabular_into_gzip(tmp_path):
+    chunks = [b"q1\ts1\t100.0\n", b"", b"q2\ts1\t99.0\nq3\ts2\t98.0\n"]
+    out = merge(tmp_path, "6", chunks, out="out.gz")
+    assert gzip.decompress(out.read_bytes()) == b"".join(chunks)
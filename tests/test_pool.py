@@ -0,0 +1,31 @@
+import pytest
+
+from src.utils import LocalPool, JobFailedError
+
+
+def flaky(tmp_path, fails):
+    runs = tmp_path / "runs"
+    return runs, "echo x >> %s; [ $(wc -l < %s) -gt %d ]" % (runs, runs, fails)
+
+
+def run_pool(tmp_path, cmd, retry):
+    done = []
+    pool = LocalPool(str(tmp_path), cores=1, retry=retry, on_success=done.append)
+    pool.add_cmd(cmd)
+    pool.close()
+    pool.run()
+    return done
+
+
+def test_pool_retries_failed_job(tmp_path):
+    runs, cmd = flaky(tmp_path, 2)
+    done = run_pool(tmp_path, cmd, retry=2)
+    assert [j.raw_cmd for j in done] == [cmd]
+    assert len(runs.read_text().split()) == 3
+
+
+def test_pool_fails_when_retries_run_out(tmp_path):
+    runs, cmd = flaky(tmp_path, 2)
+    with pytest.raises(JobFailedError):
+        run_pool(tmp_path, cmd, retry=1)
+    assert len(runs.read_text().split()) == 2
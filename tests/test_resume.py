@@ -0,0 +1,87 @@
+import os
+
+from src.src import HPCBlast, HPCBlastArg
+
+
+def hpcblast(tmp_path, *opts, evalue="10"):
+    query = tmp_path / "q.fa"
+    if not query.exists():
+        query.write_bytes(b"".join(b">q%d\n%s\n" % (i, b"ACGT" * (i + 5)) for i in range(40)))
+    args, blast_options = HPCBlastArg(["--local", "--tempdir", str(tmp_path / "tmp"), "--split", "4"] + list(opts) +
+                                      ["blastn", "-query", str(query), "-db", str(tmp_path / "db"),
+                                       "-evalue", evalue, "-outfmt", "6", "-out", str(tmp_path / "out.m6")])
+    return HPCBlast(args, blast_options)
+
+
+def first_run(tmp_path, *opts):
+    h = hpcblast(tmp_path, *opts)
+    assert not h._resume()
+    h.split_query()
+    for i, fa in enumerate(h.chunk_files):
+        res = h._chunk_result(fa, 0)
+        os.makedirs(os.path.dirname(res), exist_ok=True)
+        with open(res, "wb") as fo:
+            fo.write(b"q%d\ts1\t99.0\t20\t0\t0\t1\t20\t1\t20\t1e-5\t40.0\n" % i)
+        h.manifest.add("result", res)
+    return h
+
+
+def test_resume_keeps_verified_chunks_and_results(tmp_path, blastn):
+    first = first_run(tmp_path)
+    h = hpcblast(tmp_path)
+    assert h._resume()
+    assert h.chunk_files == first.chunk_files
+    assert len(h.completed) == 4
+
+
+def test_resume_drops_missing_result(tmp_path, blastn):
+    first = first_run(tmp_path)
+    res = first._chunk_result(first.chunk_files[2], 0)
+    os.remove(res)
+    h = hpcblast(tmp_path)
+    assert h._resume()
+    assert len(h.completed) == 3
+    assert res not in h.completed
+
+
+def test_resume_drops_result_with_corrupted_content(tmp_path, blastn):
+    first = first_run(tmp_path)
+    res = first._chunk_result(first.chunk_files[1], 0)
+    with open(res, "r+b") as fo:
+        fo.write(b"q9")
+    h = hpcblast(tmp_path)
+    assert h._resume()
+    assert len(h.completed) == 3
+    assert res not in h.completed
+
+
+def test_resume_resplits_on_corrupted_chunk(tmp_path, blastn):
+    first = first_run(tmp_path)
+    with open(first.chunk_files[0], "r+b") as fo:
+        fo.write(b">x")
+    h = hpcblast(tmp_path)
+    assert not h._resume()
+    assert not os.path.exists(first.chunk_files[0])
+    assert not h.manifest.results
+
+
+def test_resume_resplits_on_changed_split(tmp_path, blastn):
+    first_run(tmp_path)
+    h = hpcblast(tmp_path, "--balance", "residues")
+    assert not h._resume()
+    assert not (tmp_path / "tmp" / "results").exists()
+
+
+def test_resume_reruns_chunks_on_changed_blast_options(tmp_path, blastn):
+    first = first_run(tmp_path)
+    h = hpcblast(tmp_path, evalue="1e-5")
+    assert h._resume()
+    assert h.chunk_files == first.chunk_files
+    assert not h.completed
+
+
+def test_resume_resplits_cached_run_on_changed_blast_options(tmp_path, blastn):
+    first_run(tmp_path, "--cache", str(tmp_path / "cache"))
+    h = hpcblast(tmp_path, "--cache", str(tmp_path / "cache"), evalue="1e-5")
+    assert not h._resume()
+    assert not h.chunk_files and not h.completed
@@ -0,0 +1,40 @@
+import gzip
+
+from src.src import HPCBlast, HPCBlastArg
+
+
+def hpcblast(tmp_path, query, *opts):
+    args, blast_options = HPCBlastArg(["--local", "--tempdir", str(tmp_path / "tmp")] + list(opts) +
+                                      ["blastn", "-query", query, "-db", str(tmp_path / "db"),
+                                       "-outfmt", "6", "-out", str(tmp_path / "out.m6")])
+    return HPCBlast(args, blast_options)
+
+
+def write_fastq_gz(path, n=2000, length=150):
+    with gzip.open(path, "wb") as fo:
+        for i in range(n):
+            seq = (b"ACGT" * length)[i % 4:i % 4 + length]
+            fo.write(b"@r%d\n%s\n+\n%s\n" % (i, seq, b"I" * length))
+    return str(path)
+
+
+def test_pipeline_split_by_part_cuts_gzip_fastq_progressively(tmp_path, blastn):
+    query = write_fastq_gz(tmp_path / "q.fq.gz")
+    h = hpcblast(tmp_path, query, "--pipeline", "--split", "5")
+    ready = []
+    h.on_chunk = lambda fa: ready.append(len(h.chunk_files))
+    h.split_fastx_by_part(5)
+    assert len(ready) == len(h.chunk_files) == 5
+    assert ready[0] == 1
+    records = 0
+    for fa in h.chunk_files:
+        with open(fa, "rb") as fi:
+            records += fi.read().count(b">")
+    assert records == 2000
+
+
+def test_split_by_part_without_pipeline_keeps_part_chunks(tmp_path, blastn):
+    query = write_fastq_gz(tmp_path / "q.fq.gz")
+    h = hpcblast(tmp_path, query, "--split", "5")
+    h.split_fastx_by_part(5)
+    assert len(h.chunk_files) == 5
@@ -0,0 +1,81 @@
+import os
+import time
+import shlex
+import threading
+
+import pytest
+
+from src.utils import WorkQueue
+from src.worker import claim_task, run_task
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = WorkQueue(str(tmp_path / "queue"), retry=1, poll=0.05)
+    q.reset()
+    return q
+
+
+@pytest.fixture
+def stub(tmp_path):
+    exe = tmp_path / "stub"
+    exe.write_text('#!/bin/sh\ncase "$4" in *.copy"$1") echo partial > "$4"; sleep 30;; esac\n[ "$2" = 0 ] || exit "$2"\necho "$4" > "$4"\n')
+    exe.chmod(0o755)
+    return str(exe)
+
+
+def task(stub, out, slow=0, rc=0):
+    return "%s %d %d -out %s -query q.fa" % (shlex.quote(stub), slow, rc, shlex.quote(str(out)))
+
+
+def leftovers(tmp_path):
+    return sorted(f for f in os.listdir(str(tmp_path)) if ".copy" in f)
+
+
+def test_ticket_is_claimed_by_one_worker(queue, stub, tmp_path):
+    queue.put([task(stub, tmp_path / "r0")])
+    assert claim_task(queue.path) == "1-00000000.1"
+    assert claim_task(queue.path) is None
+    assert os.listdir(os.path.join(queue.path, "claimed")) == ["1-00000000.1"]
+
+
+def test_each_chunk_finishes_once(queue, stub, tmp_path):
+    queue.put([task(stub, tmp_path / "r0"), task(stub, tmp_path / "r1")])
+    queue._ticket("00000000")
+    first, second = claim_task(queue.path), claim_task(queue.path)
+    assert {first, second} == {"1-00000000.1", "0-00000000.2"}
+    run_task(queue.path, "0-00000000.2", "w2", 0.05)
+    run_task(queue.path, "1-00000000.1", "w1", 0.05)
+    done = []
+    queue.close()
+    queue.monitor(done.append)
+    assert done == [str(tmp_path / "r0"), str(tmp_path / "r1")]
+    assert (tmp_path / "r0").read_text().strip().endswith(".copy2")
+    assert leftovers(tmp_path) == []
+
+
+def test_losing_copy_is_killed_and_cleaned(queue, stub, tmp_path):
+    queue.put([task(stub, tmp_path / "r0", slow=1)])
+    slow = threading.Thread(target=run_task, args=(queue.path, claim_task(queue.path), "w1", 0.05))
+    slow.start()
+    while not (tmp_path / "r0.copy1").exists():
+        time.sleep(0.01)
+    queue._ticket("00000000")
+    run_task(queue.path, claim_task(queue.path), "w2", 0.05)
+    slow.join(10)
+    assert not slow.is_alive()
+    assert (tmp_path / "r0").read_text().strip().endswith(".copy2")
+    assert os.listdir(os.path.join(queue.path, "done")) == ["00000000.json"]
+    assert leftovers(tmp_path) == []
+
+
+def test_failed_ticket_is_requeued_until_retries_run_out(queue, stub, tmp_path):
+    queue.put([task(stub, tmp_path / "r0", rc=3)])
+    for n in range(2):
+        ticket = claim_task(queue.path)
+        assert ticket == "%d-00000000.%d" % (n == 0, n + 1)
+        run_task(queue.path, ticket, "w", 0.05)
+        queue._check_failed()
+    assert claim_task(queue.path) is None
+    assert queue.failed == ["00000000"] and not queue.pending
+    assert leftovers(tmp_path) == []